@@ -0,0 +1,6 @@
+import sys
+
+# the asyncio streaming API uses syntax that Python 2 can't parse
+collect_ignore = []
+if sys.version_info < (3, 7):
+    collect_ignore.extend(['lesion/stream.py', 'lesion/tests/test_stream.py'])
@@ -0,0 +1,395 @@
+"""
+Distribute `process.traces_dict` over several machines that share a
+filesystem, using a directory as a work queue.
+
+A queue is a directory with five subdirectories:
+
+- ``pending``: work units waiting to be claimed, one JSON file each,
+  naming an input file and a range of series.
+- ``claimed``: units being processed. A worker claims a unit by
+  atomically renaming it here, and keeps the file's modification time
+  current while it works. Claims that go stale (because their worker
+  died) are moved back to ``pending`` by any other worker.
+- ``done``: units whose results have been written.
+- ``failed``: units whose processing raised an exception, each next to
+  a ``.err`` file holding the traceback. They are not retried; move
+  them back to ``pending`` once the problem is fixed.
+- ``results``: the statistics table of each unit, as a pickled pandas
+  DataFrame. `collect` merges them into the final table.
+
+Unit and result names start with the input file's name and a short
+hash of its absolute path, so that different files with the same name
+don't overwrite each other's units.
+
+Every state change is a single ``rename`` within the queue directory,
+which is atomic on local filesystems and NFS.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import socket
+import threading
+import traceback
+
+import pandas as pd
+
+from . import process
+from . import readers
+
+
+QUEUE_DIRS = ['pending', 'claimed', 'done', 'failed', 'results']
+CLAIM_SEP = '@'
+
+
+def create(root):
+    """Create the queue directories under `root`, if needed.
+
+    Parameters
+    ----------
+    root : string
+        The queue directory.
+    """
+    for d in QUEUE_DIRS:
+        path = os.path.join(root, d)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:  # another process created it first
+                if not os.path.isdir(path):
+                    raise
+
+
+def enqueue(root, fin, series=None, unit_size=1, **kwargs):
+    """Add work units for an input file to the queue.
+
+    Parameters
+    ----------
+    root : string
+        The queue directory. It is created if needed.
+    fin : string
+        The input file, accessible at this path from every worker.
+    series : list of int, optional
+        The series to process. By default, all series in `fin`.
+    unit_size : int, optional
+        The number of series in each work unit.
+    **kwargs : keyword arguments, optional
+        Keyword arguments to be passed on to `process.traces_dict`,
+        such as `chan` or `backend`. They must be JSON-serializable.
+
+    Returns
+    -------
+    units : list of string
+        The names of the new work units.
+    """
+    create(root)
+    if series is None:
+        rdr = readers.get_reader(fin, kwargs.get('backend'))
+        series = range(rdr.series_count())
+    series = list(series)
+    key = _file_key(fin)
+    units = []
+    for start in range(0, len(series), unit_size):
+        chunk = series[start:start + unit_size]
+        name = '%s-%05i-%05i.json' % (key, chunk[0], chunk[-1])
+        unit = {'fin': os.path.abspath(fin), 'series': chunk,
+                'kwargs': kwargs}
+        _write_atomic(os.path.join(root, 'pending', name),
+                      json.dumps(unit).encode('utf-8'))
+        units.append(name)
+    return units
+
+
+def claim(root, worker_id):
+    """Claim the next pending work unit, if any.
+
+    Parameters
+    ----------
+    root : string
+        The queue directory.
+    worker_id : string
+        A name for the claiming worker, unique across machines.
+
+    Returns
+    -------
+    claimed : string or None
+        The path of the claimed unit file, or ``None`` if no unit
+        could be claimed.
+    """
+    pending_dir = os.path.join(root, 'pending')
+    for name in sorted(os.listdir(pending_dir)):
+        if not name.endswith('.json'):
+            continue
+        pending = os.path.join(pending_dir, name)
+        claimed = os.path.join(root, 'claimed', name + CLAIM_SEP + worker_id)
+        try:
+            # refresh first: rename keeps the modification time, and an
+            # old one would make the new claim look stale immediately
+            os.utime(pending, None)
+            os.rename(pending, claimed)
+        except OSError:  # another worker got there first
+            continue
+        return claimed
+    return None
+
+
+def requeue_stale(root, timeout):
+    """Move claims not refreshed in `timeout` seconds back to pending.
+
+    Parameters
+    ----------
+    root : string
+        The queue directory.
+    timeout : float
+        The age, in seconds, after which a claim is considered stale.
+
+    Returns
+    -------
+    requeued : list of string
+        The names of the requeued units.
+
+    Notes
+    -----
+    The current time is taken from the shared filesystem rather than
+    the local clock, so that clock skew between machines doesn't make
+    live claims look stale.
+    """
+    now = _filesystem_time(root)
+    requeued = []
+    claimed_dir = os.path.join(root, 'claimed')
+    for claim_name in os.listdir(claimed_dir):
+        path = os.path.join(claimed_dir, claim_name)
+        try:
+            stale = now - os.path.getmtime(path) > timeout
+            if stale:
+                name = claim_name.rsplit(CLAIM_SEP, 1)[0]
+                os.rename(path, os.path.join(root, 'pending', name))
+                requeued.append(name)
+        except OSError:  # finished or requeued concurrently
+            continue
+    return requeued
+
+
+def work(root, worker_id=None, timeout=600., heartbeat=None, poll=5.):
+    """Process work units from the queue until none remain.
+
+    Parameters
+    ----------
+    root : string
+        The queue directory.
+    worker_id : string, optional
+        A name for this worker, unique across machines. By default,
+        the host name and process ID.
+    timeout : float, optional
+        Claims not refreshed for this many seconds are assumed to
+        belong to dead workers, and are requeued.
+    heartbeat : float, optional
+        How often, in seconds, to refresh this worker's claim. By
+        default, a quarter of `timeout`.
+    poll : float, optional
+        When nothing is pending but other workers still hold claims,
+        wait this many seconds before checking for stale claims again.
+
+    Returns
+    -------
+    processed : list of string
+        The names of the units processed successfully by this worker.
+        Units that failed are moved to the ``failed`` directory.
+    """
+    if worker_id is None:
+        worker_id = '%s-%i' % (socket.gethostname(), os.getpid())
+    if heartbeat is None:
+        heartbeat = timeout / 4
+    processed = []
+    while True:
+        requeue_stale(root, timeout)
+        claimed = claim(root, worker_id)
+        if claimed is None:
+            if os.listdir(os.path.join(root, 'claimed')):
+                time.sleep(poll)
+            # a stale claim may have been requeued after we tried to
+            # claim, so only stop if nothing is pending either
+            elif not _pending(root):
+                return processed
+            continue
+        name = _process_unit(root, claimed, heartbeat)
+        if name is not None:
+            processed.append(name)
+
+
+def collect(root, fin=None):
+    """Merge the statistics of all finished work units.
+
+    Parameters
+    ----------
+    root : string
+        The queue directory.
+    fin : string, optional
+        Only collect the results of this input file.
+
+    Returns
+    -------
+    statistics : pandas DataFrame
+        The statistics, with rows for each timepoint and columns for
+        each input file (by absolute path), position and statistic.
+        ``statistics[os.path.abspath(fin)]`` is the table returned by
+        `process.traces_dict` on all the queued series of `fin`. If
+        `fin` is given, that table is returned directly.
+    """
+    results_dir = os.path.join(root, 'results')
+    statistics = None
+    for name in sorted(os.listdir(results_dir)):
+        if not name.endswith('.pkl'):
+            continue
+        if fin is not None and not name.startswith(_file_key(fin) + '-'):
+            continue
+        unit_stats = pd.read_pickle(os.path.join(results_dir, name))
+        if statistics is None:
+            statistics = unit_stats
+        else:
+            statistics = statistics.combine_first(unit_stats)
+    if statistics is None:
+        raise ValueError("No results found in queue %s." % root)
+    statistics = statistics.sort_index().sort_index(axis=1)
+    if fin is not None:
+        statistics = statistics[os.path.abspath(fin)]
+    return statistics
+
+
+def _process_unit(root, claimed, heartbeat):
+    """Run `traces_dict` on a claimed unit and record its result.
+
+    Parameters
+    ----------
+    root : string
+        The queue directory.
+    claimed : string
+        The path of the claimed unit file.
+    heartbeat : float
+        How often, in seconds, to refresh the claim while working.
+
+    Returns
+    -------
+    name : string or None
+        The name of the processed unit, or ``None`` if processing
+        raised an exception. In that case, the unit is moved to the
+        ``failed`` directory, next to a ``.err`` file holding the
+        traceback, so that it isn't claimed again.
+    """
+    claim_name = os.path.basename(claimed)
+    name = claim_name.rsplit(CLAIM_SEP, 1)[0]
+    with open(claimed) as fin:
+        unit = json.load(fin)
+    stop = threading.Event()
+    beat = threading.Thread(target=_keep_alive,
+                            args=(claimed, heartbeat, stop))
+    beat.daemon = True
+    beat.start()
+    try:
+        _, statistics = process.traces_dict(unit['fin'], unit['series'],
+                                            **unit['kwargs'])
+    except Exception:
+        failed = os.path.join(root, 'failed', name)
+        _write_atomic(os.path.splitext(failed)[0] + '.err',
+                      traceback.format_exc().encode('utf-8'))
+        try:
+            os.rename(claimed, failed)
+        except OSError:  # our claim was requeued; let it fail again
+            pass
+        return None
+    finally:
+        stop.set()
+        beat.join()
+    # label the columns with the input file, so files don't mix in collect
+    statistics = pd.concat({unit['fin']: statistics}, axis=1)
+    result = os.path.join(root, 'results',
+                          os.path.splitext(name)[0] + '.pkl')
+    statistics.to_pickle(result + '.tmp' + CLAIM_SEP + claim_name)
+    os.rename(result + '.tmp' + CLAIM_SEP + claim_name, result)
+    try:
+        os.rename(claimed, os.path.join(root, 'done', name))
+    except OSError:  # our claim was requeued; the result is still valid
+        pass
+    return name
+
+
+def _file_key(fin):
+    """Name the units of `fin` uniquely among all input files.
+
+    Examples
+    --------
+    >>> _file_key('/data/exp.lif') == _file_key('/data/exp.lif')
+    True
+    >>> _file_key('/data/a/exp.lif') == _file_key('/data/b/exp.lif')
+    False
+    """
+    path = os.path.abspath(fin)
+    base = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:8]
+    return '%s-%s' % (base, digest)
+
+
+def _pending(root):
+    """Return ``True`` if any work unit is waiting to be claimed."""
+    return any(name.endswith('.json')
+               for name in os.listdir(os.path.join(root, 'pending')))
+
+
+def _keep_alive(path, interval, stop):
+    """Refresh the modification time of `path` until `stop` is set."""
+    while not stop.wait(interval):
+        try:
+            os.utime(path, None)
+        except OSError:  # the claim was requeued
+            return
+
+
+def _filesystem_time(root):
+    """Return the current time according to the filesystem of `root`."""
+    clock = os.path.join(root, 'clock' + CLAIM_SEP + socket.gethostname() +
+                         '-%i' % os.getpid())
+    with open(clock, 'w'):
+        pass
+    now = os.path.getmtime(clock)
+    os.remove(clock)
+    return now
+
+
+def _write_atomic(filename, data):
+    """Write `data` to `filename` so that readers never see it partially.
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as fout:
+        fout.write(data)
+    os.rename(tmp, filename)
+
+
+def _main(argv=sys.argv):
+    """Run the queue from the command line.
+
+    Usage::
+
+        python -m lesion.batch enqueue QUEUE FILE [FILE ...]
+        python -m lesion.batch work QUEUE
+        python -m lesion.batch collect QUEUE OUTPUT.csv
+
+    Parameters
+    ----------
+    argv : list of string, optional
+        The argument vector. Used mainly for testing.
+    """
+    command, root, args = argv[1], argv[2], argv[3:]
+    if command == 'enqueue':
+        for fin in args:
+            enqueue(root, fin)
+    elif command == 'work':
+        work(root)
+    elif command == 'collect':
+        collect(root).to_csv(args[0])
+    else:
+        raise ValueError("Unknown command: %s" % command)
+
+
+if __name__ == '__main__': # pragma: no cover
+    _main()
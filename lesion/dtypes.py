@@ -0,0 +1,92 @@
+"""
+The data type policy of the pipeline.
+
+Z projections accumulate into the smallest integer type that cannot
+overflow, rather than a fixed type. Traces and statistics keep the
+floating point precision they are given (or are asked for), so that a
+whole analysis can run in float32 without intermediate float64
+copies.
+"""
+import numpy as np
+
+
+UNSIGNED_TYPES = [np.uint8, np.uint16, np.uint32, np.uint64]
+SIGNED_TYPES = [np.int8, np.int16, np.int32, np.int64]
+
+
+def projection_dtype(dtype, n):
+    """Find a data type that can hold the sum of `n` values of `dtype`.
+
+    Parameters
+    ----------
+    dtype : numpy dtype
+        The data type of the summed values.
+    n : int
+        The number of values summed, such as the number of planes in a
+        Z projection.
+
+    Returns
+    -------
+    sum_dtype : numpy dtype
+        The smallest integer type of the same signedness that cannot
+        overflow, or `dtype` itself if it is floating point. If no
+        integer type is wide enough, float64.
+
+    Examples
+    --------
+    >>> projection_dtype(np.uint8, 1)
+    dtype('uint8')
+    >>> projection_dtype(np.uint8, 25)
+    dtype('uint16')
+    >>> projection_dtype(np.uint16, 25)
+    dtype('uint32')
+    >>> projection_dtype(np.int16, 2)
+    dtype('int32')
+    >>> projection_dtype(np.float32, 100)
+    dtype('float32')
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return dtype
+    if dtype.kind == 'b':
+        dtype = np.dtype(np.uint8)
+    info = np.iinfo(dtype)
+    candidates = UNSIGNED_TYPES if dtype.kind == 'u' else SIGNED_TYPES
+    for candidate in candidates:
+        candidate_info = np.iinfo(candidate)
+        if (candidate_info.max >= info.max * max(n, 1) and
+                candidate_info.min <= info.min * max(n, 1)):
+            return np.dtype(candidate)
+    return np.dtype(np.float64)
+
+
+def as_float(array, dtype=None):
+    """Return `array` as floating point, copying only when necessary.
+
+    Parameters
+    ----------
+    array : array-like
+        The input array.
+    dtype : numpy dtype, optional
+        The desired floating point type. By default, floating point
+        arrays keep their type, and other arrays are converted to
+        float64.
+
+    Returns
+    -------
+    out : array of float
+        `array` itself if it already has the desired type, otherwise a
+        converted copy.
+
+    Examples
+    --------
+    >>> x = np.arange(3, dtype=np.float32)
+    >>> as_float(x) is x
+    True
+    >>> as_float(np.arange(3)).dtype
+    dtype('float64')
+    """
+    array = np.asarray(array)
+    if dtype is None:
+        dtype = array.dtype if array.dtype.kind == 'f' else np.float64
+    return array.astype(dtype, copy=False)
@@ -0,0 +1,301 @@
+"""
+Compiled kernels for the hot loops of tracing and statistics.
+
+The functions in this module process whole stacks of distributions or
+traces in one call. If Numba is installed, they run as single
+JIT-compiled loops. Otherwise, they fall back on the NumPy and
+scikit-image reference implementations used elsewhere in `lesion`,
+which give the same results.
+
+Numba is only imported, and the loops compiled, when a kernel is first
+called, and scikit-image only when a reference implementation first
+runs, so importing `lesion` stays fast.
+"""
+import numpy as np
+
+from . import stats
+
+
+# None: use Numba if it is installed. Set to False to force the
+# reference implementations, or to True to force the loops, which run
+# in Python if Numba is missing.
+USE_NUMBA = None
+
+_numba = None
+_JIT_FUNCTIONS = []
+_compiled = False
+
+
+def have_numba():
+    """Return ``True`` if Numba can be imported.
+
+    The first call imports Numba.
+    """
+    global _numba
+    if _numba is None:
+        try:
+            import numba
+            _numba = numba
+        except ImportError:
+            _numba = False
+    return _numba is not False
+
+
+def _jit(func):
+    """Mark `func` to be compiled with Numba when a kernel first runs.
+
+    The function is returned unchanged. `_use_loops` replaces it in
+    the module namespace with its compiled version, so that compiled
+    kernels calling each other are resolved by Numba.
+    """
+    _JIT_FUNCTIONS.append(func.__name__)
+    return func
+
+
+def _use_loops():
+    """Return ``True`` if the kernels should run their loops.
+
+    The first time this returns ``True`` with Numba installed, all loop
+    functions are compiled.
+    """
+    global _compiled
+    use_loops = USE_NUMBA
+    if use_loops is None:
+        use_loops = have_numba()
+    if use_loops and not _compiled and have_numba():
+        namespace = globals()
+        for name in _JIT_FUNCTIONS:
+            namespace[name] = _numba.njit(cache=True,
+                                          error_model='numpy')(namespace[name])
+        _compiled = True
+    return use_loops
+
+
+def mode_width(distributions):
+    """Estimate the mode and width-at-half-maximum of many distributions.
+
+    Parameters
+    ----------
+    distributions : array of int or float, shape (K, N)
+        The input distributions, one per row.
+
+    Returns
+    -------
+    modes : array of int, shape (K,)
+        The location of the mode of each distribution.
+    whms : array of int, shape (K,)
+        The number of values in each distribution above half its mode.
+
+    See Also
+    --------
+    lesion.trace.estimate_mode_width
+
+    Examples
+    --------
+    >>> distributions = np.array([[0, 4, 8, 16, 22, 16, 8, 4, 0],
+    ...                           [8, 16, 22, 16, 8, 4, 0, 0, 0]])
+    >>> modes, whms = mode_width(distributions)
+    >>> modes, whms
+    (array([4, 2]), array([3, 3]))
+    """
+    distributions = np.asarray(distributions)
+    if _use_loops():
+        modes = np.empty(len(distributions), np.intp)
+        whms = np.empty(len(distributions), np.intp)
+        _mode_width_loops(distributions, modes, whms)
+        return modes, whms
+    modes = distributions.argmax(axis=1)
+    halfmax = distributions[np.arange(len(distributions)), modes] / 2.
+    whms = (distributions > halfmax[:, np.newaxis]).sum(axis=1)
+    return modes, whms
+
+
+def profile_line(image, src, dst, linewidth=1, dtype=np.float64):
+    """Sample the mean intensity across a thick line in an image.
+
+    This is equivalent to ``skimage.measure.profile_line`` with
+    linear interpolation and ``mode='nearest'``.
+
+    Parameters
+    ----------
+    image : array, shape (M, N)
+        The input image.
+    src, dst : pair of float
+        The (row, column) coordinates of the start and end of the line.
+        Both are included in the profile.
+    linewidth : int, optional
+        The width of the line, in pixels.
+    dtype : numpy dtype, optional
+        The floating point type of the output.
+
+    Returns
+    -------
+    profile : 1D array of float
+        The mean intensity across the line at each point along it.
+
+    Examples
+    --------
+    >>> image = np.array([[0, 0, 0], [1, 2, 3], [0, 0, 0]])
+    >>> profile_line(image, (1, 0), (1, 2), linewidth=3)
+    array([ 0.33333333,  0.66666667,  1.        ])
+    """
+    if _use_loops():
+        profile = np.empty(_line_length(src, dst), dtype)
+        # skimage interpolates integer images into their own dtype
+        round_samples = np.issubdtype(image.dtype, np.integer)
+        _profile_line_loops(image, float(src[0]), float(src[1]),
+                            float(dst[0]), float(dst[1]), int(linewidth),
+                            round_samples, profile)
+        return profile
+    from skimage import measure
+    profile = measure.profile_line(image, src, dst, linewidth=linewidth,
+                                   mode='nearest')
+    return profile.astype(dtype, copy=False)
+
+
+def trace_stats(traces, dtype=np.float64):
+    """Compute all default statistics of many traces at once.
+
+    Parameters
+    ----------
+    traces : list of 1D array of float
+        The input profiles. They need not have the same length.
+    dtype : numpy dtype, optional
+        The floating point type of the output.
+
+    Returns
+    -------
+    values : array of float, shape (len(traces), 3)
+        For each trace, its `stats.min_max`, `stats.slope`, and
+        `stats.missing_fluorescence`, with default parameters.
+
+    Examples
+    --------
+    >>> traces = [np.array([5, 5, 5, 0, 2, 1, 0, 5, 5, 5]),
+    ...           np.array([0.8, 0.9, 1.4, 2.0, 1.1])]
+    >>> np.round(trace_stats(traces), 2)
+    array([[  0.  ,   1.67,  10.2 ],
+           [  0.4 ,   0.4 ,   0.92]])
+    """
+    if _use_loops():
+        lengths = np.array([len(tr) for tr in traces], np.intp)
+        padded = np.zeros((len(traces), max(lengths) if len(traces) else 0),
+                          dtype)
+        for i, tr in enumerate(traces):
+            padded[i, :len(tr)] = tr
+        values = np.empty((len(traces), 3), dtype)
+        _trace_stats_loops(padded, lengths, 50, values)
+        return values
+    values = [[stats.min_max(tr), stats.slope(tr),
+               stats.missing_fluorescence(tr)] for tr in traces]
+    return np.array(values, dtype=dtype).reshape((len(traces), 3))
+
+
+def _line_length(src, dst):
+    """Return the number of samples in a profile from `src` to `dst`."""
+    return int(np.ceil(np.hypot(float(dst[0]) - float(src[0]),
+                                float(dst[1]) - float(src[1])) + 1))
+
+
+@_jit
+def _mode_width_loops(distributions, modes, whms):
+    for i in range(distributions.shape[0]):
+        mode = 0
+        for j in range(1, distributions.shape[1]):
+            if distributions[i, j] > distributions[i, mode]:
+                mode = j
+        halfmax = distributions[i, mode] / 2.
+        whm = 0
+        for j in range(distributions.shape[1]):
+            if distributions[i, j] > halfmax:
+                whm += 1
+        modes[i] = mode
+        whms[i] = whm
+
+
+@_jit
+def _interpolate(image, row, col):
+    """Bilinear interpolation, clamping coordinates to the image."""
+    nrows, ncols = image.shape
+    row = min(max(row, 0.), nrows - 1.)
+    col = min(max(col, 0.), ncols - 1.)
+    r0 = min(int(row), nrows - 1)
+    c0 = min(int(col), ncols - 1)
+    r1 = min(r0 + 1, nrows - 1)
+    c1 = min(c0 + 1, ncols - 1)
+    dr = row - r0
+    dc = col - c0
+    top = image[r0, c0] * (1 - dc) + image[r0, c1] * dc
+    bottom = image[r1, c0] * (1 - dc) + image[r1, c1] * dc
+    return top * (1 - dr) + bottom * dr
+
+
+@_jit
+def _profile_line_loops(image, src_row, src_col, dst_row, dst_col,
+                        linewidth, round_samples, profile):
+    # same sampling scheme as skimage.measure.profile_line
+    length = profile.shape[0]
+    theta = np.arctan2(dst_row - src_row, dst_col - src_col)
+    col_width = (linewidth - 1) * np.sin(-theta) / 2
+    row_width = (linewidth - 1) * np.cos(theta) / 2
+    for i in range(length):
+        if length > 1:
+            frac = i / (length - 1.)
+        else:
+            frac = 0.
+        row = src_row + frac * (dst_row - src_row)
+        col = src_col + frac * (dst_col - src_col)
+        total = 0.
+        for k in range(linewidth):
+            if linewidth > 1:
+                across = k / (linewidth - 1.)
+            else:
+                across = 0.
+            # skimage flips the perpendicular samples; the mean doesn't care
+            sample = _interpolate(image,
+                                  row - row_width + 2 * row_width * across,
+                                  col - col_width + 2 * col_width * across)
+            if round_samples:
+                if sample >= 0:
+                    sample = np.floor(sample + 0.5)
+                else:
+                    sample = np.ceil(sample - 0.5)
+            total += sample
+        if linewidth > 0:
+            profile[i] = total / linewidth
+        else:
+            profile[i] = np.nan
+
+
+@_jit
+def _trace_stats_loops(traces, lengths, margins, values):
+    for i in range(traces.shape[0]):
+        n = lengths[i]
+        lo, hi = 0, 0
+        for j in range(1, n):
+            if traces[i, j] < traces[i, lo]:
+                lo = j
+            if traces[i, j] > traces[i, hi]:
+                hi = j
+        low, high = traces[i, lo], traces[i, hi]
+        # min_max
+        if high != 0:
+            values[i, 0] = low / high
+        else:  # low <= high == 0
+            values[i, 0] = np.nan if low == 0 else -np.inf
+        # slope
+        if lo != hi:
+            values[i, 1] = abs((low - high) / (lo - hi))
+        else:
+            values[i, 1] = np.nan
+        # missing_fluorescence
+        m = min(margins, n)
+        height = 0.
+        for j in range(m):
+            height += traces[i, j] + traces[i, n - m + j]
+        height = height / m / 2 if m > 0 else np.nan
+        missing = 0.
+        for j in range(n):
+            clipped = min(max(traces[i, j], 0.), height)
+            missing += height - clipped
+        values[i, 2] = missing
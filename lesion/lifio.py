@@ -1,15 +1,28 @@
+import os
+import json
 import numpy as np
 import re
-import collections as coll
 import itertools as it
-import javabridge as jv
-import bioformats as bf
-from xml import etree as et
+try:
+    from collections.abc import Iterable
+except ImportError:  # Python 2
+    from collections import Iterable
+from xml.etree import ElementTree
 
+# javabridge and bioformats are slow to import and need Java, so they
+# are only imported when first needed. See `_import_bioformats`.
+jv = None
+bf = None
 
 VM_STARTED = False
 VM_KILLED = False
 DEFAULT_DIM_ORDER = 'tzyxc'
+STORE_INDEX = 'index.json'
+STORE_ORDER = 'TZCYX'
+
+RE_PRE = re.compile(r"Pre.*/Pos(\d+)_.*")
+RE_MARK = re.compile(r"Mark.*/Pos(\d+)_.*")
+RE_TIME = re.compile(r"(\d+(\.\d+)?)h? to (\d+(\.\d+)?) ?h.*/Pos(\d+)_.*")
 
 
 BF2NP_DTYPE = {
@@ -24,6 +37,15 @@ BF2NP_DTYPE = {
 }
 
 
+def _import_bioformats():
+    """Import javabridge and bioformats into this module on first use."""
+    global jv, bf
+    if bf is None:
+        import javabridge
+        import bioformats
+        jv, bf = javabridge, bioformats
+
+
 def start(max_heap_size='8G'):
     """Start the Java Virtual Machine, enabling bioformats IO.
 
@@ -33,6 +55,7 @@ def start(max_heap_size='8G'):
         The maximum memory usage by the virtual machine. Valid strings
         include '256M', '64k', and '2G'. Expect to need a lot.
     """
+    _import_bioformats()
     jv.start_vm(class_path=bf.JARS, max_heap_size=max_heap_size)
     global VM_STARTED
     VM_STARTED = True
@@ -44,11 +67,41 @@ def done():
     -----
     See the python-javabridge documentation for more information.
     """
+    _import_bioformats()
     jv.kill_vm()
     global VM_KILLED
     VM_KILLED = True
 
 
+def attach_thread():
+    """Attach the current thread to the JVM, so it can read files.
+
+    The thread that started the JVM is attached automatically. Other
+    threads must call this before using bioformats, and
+    `detach_thread` when they are done.
+    """
+    if not VM_STARTED:
+        start()
+    if VM_KILLED:
+        raise RuntimeError("The Java Virtual Machine has already been "
+                           "killed, and cannot be restarted. See the "
+                           "python-javabridge documentation for more "
+                           "information. You must restart your program "
+                           "and try again.")
+    _import_bioformats()
+    jv.attach()
+
+
+def detach_thread():
+    """Detach the current thread from the JVM.
+
+    Call this from a thread attached with `attach_thread` once it no
+    longer needs to read files, so that the JVM can release it.
+    """
+    _import_bioformats()
+    jv.detach()
+
+
 def lif_metadata_string_size(filename):
     """Get the length in bytes of the metadata string of a LIF file.
 
@@ -103,7 +156,7 @@ def parse_xml_metadata(xml_string, array_order=DEFAULT_DIM_ORDER):
     spatial_array_order = [c for c in array_order if c in 'XYZ']
     size_tags = ['Size' + c for c in array_order]
     res_tags = ['PhysicalSize' + c for c in spatial_array_order]
-    metadata_root = et.ElementTree.fromstring(xml_string)
+    metadata_root = ElementTree.fromstring(xml_string)
     for child in metadata_root:
         if child.tag.endswith('Image'):
             names.append(child.attrib['Name'])
@@ -137,7 +190,14 @@ def metadata(filename, array_order=DEFAULT_DIM_ORDER):
     resolutions : list of tuple of float
         The resolution of each series in the order given by
         `array_order`. Time and channel dimensions are ignored.
+
+    Notes
+    -----
+    If `filename` is an array store written by `transcode`, the
+    metadata is read from the store's index, without starting the JVM.
     """
+    if is_store(filename):
+        return image_reader(filename).metadata(array_order)
     if not VM_STARTED:
         start()
     if VM_KILLED:
@@ -191,12 +251,9 @@ def parse_series_name(name, interval=0.5):
     >>> e3, t3[:5]
     (4, array([ 63.,  64.,  65.,  66.,  67.]))
     """
-    re_pre = r"Pre.*/Pos(\d+)_.*"
-    re_mark = r"Mark.*/Pos(\d+)_.*"
-    re_time = r"(\d+(\.\d+)?)h? to (\d+(\.\d+)?) ?h.*/Pos(\d+)_.*"
-    m_pre = re.match(re_pre, name)
-    m_mark = re.match(re_mark, name)
-    m_time = re.match(re_time, name)
+    m_pre = RE_PRE.match(name)
+    m_mark = RE_MARK.match(name)
+    m_time = RE_TIME.match(name)
     if m_pre:
         return int(m_pre.groups()[0]), np.array([-1.])
     elif m_mark:
@@ -212,25 +269,179 @@ def parse_series_name(name, interval=0.5):
         raise ValueError("Could not parse name string: %s" % name)
 
 
+SERIES_DTYPE = np.dtype([('series_id', np.intp),
+                         ('position', np.intp),
+                         ('start', np.float64),
+                         ('stop', np.float64),
+                         ('time_offset', np.intp),
+                         ('ntimes', np.intp),
+                         ('size', np.intp, (5,)),
+                         ('resolution', np.float64, (3,))])
+
+
+class SeriesIndex(object):
+    """Parsed metadata of a set of image series, in compact arrays.
+
+    Build it once per file with `SeriesIndex.from_metadata`, then query
+    it instead of re-parsing the series names.
+
+    Parameters
+    ----------
+    series : structured array of SERIES_DTYPE
+        One record per series: its ID in the file, its position, the
+        first and last of its timepoints, the offset and number of its
+        timepoints in `times`, and its size and resolution.
+    times : 1D array of float
+        The timepoints of all series, concatenated.
+    array_order : string, optional
+        The dimension order of the ``size`` and ``resolution`` fields.
+
+    Attributes
+    ----------
+    series : structured array of SERIES_DTYPE
+        The per-series records.
+    all_times : 1D array of float
+        The concatenated timepoints.
+    array_order : string
+        The dimension order of the ``size`` and ``resolution`` fields.
+
+    Examples
+    --------
+    >>> names = ['Pre lesion 2x/Pos008_S001', '1h to 2h pSCI/Pos008_S001',
+    ...          '1h to 2h pSCI/Pos009_S001']
+    >>> index = SeriesIndex.from_metadata(names, series_ids=[3, 4, 5])
+    >>> len(index)
+    3
+    >>> index.positions()
+    array([8, 9])
+    >>> index.series['series_id'][index.for_position(8)]
+    array([3, 4])
+    >>> index.times(1)
+    array([ 1. ,  1.5,  2. ])
+    >>> index.covering(1.5, 3)
+    array([1, 2])
+    >>> index.unique_times()
+    array([-1. ,  1. ,  1.5,  2. ])
+    """
+    def __init__(self, series, times, array_order=DEFAULT_DIM_ORDER):
+        self.series = series
+        self.all_times = times
+        self.array_order = array_order
+
+    @classmethod
+    def from_metadata(cls, names, sizes=None, resolutions=None,
+                      series_ids=None, interval=0.5,
+                      array_order=DEFAULT_DIM_ORDER):
+        """Build an index by parsing each series name once.
+
+        Parameters
+        ----------
+        names : list of string
+            The name of each series, as returned by `metadata`.
+        sizes, resolutions : list of tuple, optional
+            The size and resolution of each series, as returned by
+            `metadata` with `array_order`. Zero if not given.
+        series_ids : list of int, optional
+            The ID of each series in its file. By default,
+            ``range(len(names))``.
+        interval : float, optional
+            The time interval passed to `parse_series_name`.
+        array_order : string, optional
+            The dimension order of `sizes` and `resolutions`.
+
+        Returns
+        -------
+        index : SeriesIndex
+            The index.
+        """
+        if series_ids is None:
+            series_ids = range(len(names))
+        series = np.zeros(len(names), dtype=SERIES_DTYPE)
+        all_times = []
+        offset = 0
+        for i, (series_id, name) in enumerate(zip(series_ids, names)):
+            position, times = parse_series_name(name, interval)
+            series[i]['series_id'] = series_id
+            series[i]['position'] = position
+            series[i]['start'] = times[0]
+            series[i]['stop'] = times[-1]
+            series[i]['time_offset'] = offset
+            series[i]['ntimes'] = len(times)
+            all_times.append(times)
+            offset += len(times)
+        if sizes is not None:
+            series['size'] = sizes
+        if resolutions is not None:
+            series['resolution'] = resolutions
+        times = (np.concatenate(all_times) if all_times
+                 else np.zeros(0, np.float64))
+        return cls(series, times, array_order)
+
+    def __len__(self):
+        return len(self.series)
+
+    def times(self, i):
+        """Return the timepoints of the `i`-th series in the index."""
+        record = self.series[i]
+        offset, ntimes = record['time_offset'], record['ntimes']
+        return self.all_times[offset:offset + ntimes]
+
+    def positions(self):
+        """Return the sorted unique positions in the index."""
+        return np.unique(self.series['position'])
+
+    def for_position(self, position):
+        """Return the index rows of all series at `position`."""
+        return np.flatnonzero(self.series['position'] == position)
+
+    def covering(self, t0, t1):
+        """Return the index rows of series with timepoints in [t0, t1].
+
+        A series is included if its time range overlaps the interval,
+        even if none of its discrete timepoints falls inside it.
+        """
+        series = self.series
+        return np.flatnonzero((series['start'] <= t1) &
+                              (series['stop'] >= t0))
+
+    def unique_times(self):
+        """Return all unique timepoints represented in the index.
+
+        Series sharing a start time are assumed to share all their
+        timepoints, so only the first series with each start time is
+        considered.
+        """
+        _, first = np.unique(self.series['start'], return_index=True)
+        if len(first) == 0:
+            return np.zeros(0, np.float64)
+        return np.unique(np.concatenate([self.times(i) for i in first]))
+
+
 def image_reader(filelike):
     """Return a BioFormats ``ImageReader`` object from filelike.
 
     Parameters
     ----------
-    filelike : string or bf.ImageReader
-        If string, open the corresponding ImageReader. If ImageReader,
-        this function is a no-op.
+    filelike : string, bf.ImageReader, or ArrayStore
+        If string, open the corresponding ImageReader, or the
+        corresponding `ArrayStore` if the string points to one. If
+        ImageReader or ArrayStore, this function is a no-op.
 
     Returns
     -------
-    rdr : bf.ImageReader
+    rdr : bf.ImageReader or ArrayStore
         The relevant reader.
 
     Notes
     -----
     The purpose of this function is to provide a *robust* way to open
     a BioFormats file --- without having to start the JVM manually.
+    Array stores never start the JVM.
     """
+    if isinstance(filelike, ArrayStore):
+        return filelike
+    if is_store(filelike):
+        return ArrayStore(filelike)
     if not VM_STARTED:
         start()
     if VM_KILLED:
@@ -239,6 +450,7 @@ def image_reader(filelike):
                            "python-javabridge documentation for more "
                            "information. You must restart your program "
                            "and try again.")
+    _import_bioformats()
     if isinstance(filelike, bf.ImageReader):
         rdr = filelike
     else:
@@ -252,9 +464,10 @@ def read_image_series(filelike, series_id=0, t=None, z=None, c=None,
 
     Parameters
     ----------
-    filelike : string or bf.ImageReader
-        Either a filename containing a BioFormats image, or a
-        `bioformats.ImageReader`.
+    filelike : string, bf.ImageReader, or ArrayStore
+        Either a filename containing a BioFormats image, a
+        `bioformats.ImageReader`, or an array store written by
+        `transcode` (or the path to one).
     series_id : int, optional
         Load this series from the image file.
     t : int or list of int, optional
@@ -275,9 +488,13 @@ def read_image_series(filelike, series_id=0, t=None, z=None, c=None,
     Returns
     -------
     image : numpy ndarray, 5 dimensions
-        The read image.
+        The read image. When reading from an array store, this is a
+        read-only view of a memory-mapped file whenever `t`, `z` and
+        `c` are `None` or single integers.
     """
     rdr = image_reader(filelike)
+    if isinstance(rdr, ArrayStore):
+        return _read_store_series(rdr, series_id, t, z, c, desired_order)
     reader = rdr.rdr
     total_series = reader.getSeriesCount()
     if not 0 <= series_id < total_series:
@@ -297,18 +514,23 @@ def read_image_series(filelike, series_id=0, t=None, z=None, c=None,
         new_shape = old_shape[::-1]
         desired_order = order[::-1]
     image = np.empty(new_shape, dtype=BF2NP_DTYPE[reader.getPixelType()])
+    # the position of each selected c, z and t value in the output image
+    slots = ({}, {}, {})
+    for czt in czt_list:
+        for slot, value in zip(slots, czt):
+            slot.setdefault(value, len(slot))
     for c, z, t in czt_list:
         indices = []
         for d in desired_order:
             if d == 'C':
-                indices.append(c)
+                indices.append(slots[0][c])
             elif d == 'Z':
-                indices.append(z)
+                indices.append(slots[1][z])
             elif d == 'T':
-                indices.append(t)
+                indices.append(slots[2][t])
             else:
                 indices.append(slice(None))
-        image[indices] = rdr.read(z=z, t=t, c=c, series=series_id,
+        image[tuple(indices)] = rdr.read(z=z, t=t, c=c, series=series_id,
                                   rescale=False)
     return image
 
@@ -318,7 +540,7 @@ def series_iterator(filelike, series=None, **kwargs):
 
     Parameters
     ----------
-    filelike : string or bf.ImageReader
+    filelike : string, bf.ImageReader, or ArrayStore
         The input file.
     series : iterable of int, optional
         Limit the iteration to the specified series.
@@ -332,11 +554,241 @@ def series_iterator(filelike, series=None, **kwargs):
     """
     rdr = image_reader(filelike)
     if series is None:
-        series = range(rdr.rdr.getSeriesCount())
+        if isinstance(rdr, ArrayStore):
+            series = range(rdr.series_count())
+        else:
+            series = range(rdr.rdr.getSeriesCount())
     for series_id in series:
         yield read_image_series(rdr, series_id, **kwargs)
 
 
+class ArrayStore(object):
+    """A directory of transcoded image series, one ``.npy`` file each.
+
+    Parameters
+    ----------
+    path : string
+        The store directory, as written by `transcode`.
+
+    Attributes
+    ----------
+    path : string
+        The store directory.
+    index : dict
+        The contents of the store's JSON index: the series names,
+        sizes and resolutions (as given by `metadata` in the order
+        ``index['array_order']``), the parsed positions and times of
+        each series (``None`` where the name could not be parsed), and
+        the file holding each series, in ``index['store_order']``.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, STORE_INDEX)) as fin:
+            self.index = json.load(fin)
+
+    def series_count(self):
+        """Return the number of series in the store."""
+        return len(self.index['names'])
+
+    def read(self, series_id):
+        """Memory-map the full array of one series, read-only.
+
+        Parameters
+        ----------
+        series_id : int
+            The series to read.
+
+        Returns
+        -------
+        image : numpy memmap, 5 dimensions
+            The series, in the order ``index['store_order']``.
+        """
+        filename = os.path.join(self.path, self.index['files'][series_id])
+        return np.load(filename, mmap_mode='r')
+
+    def metadata(self, array_order=DEFAULT_DIM_ORDER):
+        """Return the stored metadata in the given order.
+
+        See `metadata` for a description of the parameters and return
+        values.
+        """
+        stored_order = self.index['array_order'].upper()
+        array_order = array_order.upper()
+        size_order = _get_ordering(stored_order, array_order)
+        res_order = _get_ordering(
+                            ''.join([c for c in stored_order if c in 'XYZ']),
+                            ''.join([c for c in array_order if c in 'XYZ']))
+        names = list(self.index['names'])
+        sizes = [tuple([size[i] for i in size_order])
+                 for size in self.index['sizes']]
+        resolutions = [tuple([res[i] for i in res_order])
+                       for res in self.index['resolutions']]
+        return names, sizes, resolutions
+
+
+def is_store(filelike):
+    """Determine whether `filelike` is an array store.
+
+    Parameters
+    ----------
+    filelike : any object
+        The candidate store, such as a path or a reader.
+
+    Returns
+    -------
+    store : bool
+        ``True`` if `filelike` is an `ArrayStore` or a directory
+        containing a store index.
+    """
+    if isinstance(filelike, ArrayStore):
+        return True
+    try:
+        return os.path.isfile(os.path.join(filelike, STORE_INDEX))
+    except (TypeError, AttributeError):
+        return False
+
+
+def write_store(path, names, sizes, resolutions, images, interval=0.5,
+                source=None):
+    """Write image series and their metadata to an array store.
+
+    Parameters
+    ----------
+    path : string
+        The store directory. It is created if it doesn't exist.
+    names, sizes, resolutions : list
+        The metadata of the series, as returned by `metadata` with the
+        default `array_order`.
+    images : iterable of array, 5 dimensions
+        The image of each series, in ``STORE_ORDER``. Series are
+        written as they are consumed, so only one is in memory at a
+        time when this is an iterator.
+    interval : float, optional
+        The time interval passed to `parse_series_name`.
+    source : string, optional
+        The file from which the series were read, for the record.
+
+    Returns
+    -------
+    store : ArrayStore
+        The newly written store.
+
+    Notes
+    -----
+    The index is written last, so an interrupted write does not leave
+    behind a directory that `is_store` would accept.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    files, positions, times = [], [], []
+    for series_id, (name, image) in enumerate(zip(names, images)):
+        filename = 'series-%04i.npy' % series_id
+        np.save(os.path.join(path, filename), image)
+        files.append(filename)
+        try:
+            position, series_times = parse_series_name(name, interval)
+            positions.append(position)
+            times.append([float(t) for t in series_times])
+        except ValueError:
+            positions.append(None)
+            times.append(None)
+    index = {'source': source,
+             'array_order': DEFAULT_DIM_ORDER,
+             'store_order': STORE_ORDER,
+             'interval': interval,
+             'names': list(names),
+             'sizes': [list(size) for size in sizes],
+             'resolutions': [list(res) for res in resolutions],
+             'positions': positions,
+             'times': times,
+             'files': files}
+    index_filename = os.path.join(path, STORE_INDEX)
+    with open(index_filename + '.tmp', 'w') as fout:
+        json.dump(index, fout)
+    os.rename(index_filename + '.tmp', index_filename)
+    return ArrayStore(path)
+
+
+def transcode(filename, path, interval=0.5):
+    """Decode every series of a BioFormats file into an array store.
+
+    Subsequent reads from the store with `metadata`,
+    `read_image_series` and `series_iterator` are memory-mapped and do
+    not need the JVM.
+
+    Parameters
+    ----------
+    filename : string
+        The input BioFormats (e.g. LIF) file.
+    path : string
+        The directory in which to write the store.
+    interval : float, optional
+        The time interval passed to `parse_series_name`.
+
+    Returns
+    -------
+    store : ArrayStore
+        The newly written store.
+    """
+    names, sizes, resolutions = metadata(filename)
+    rdr = image_reader(filename)
+    images = series_iterator(rdr, desired_order=STORE_ORDER)
+    return write_store(path, names, sizes, resolutions, images,
+                       interval=interval, source=os.path.abspath(filename))
+
+
+def _read_store_series(store, series_id, t, z, c, desired_order):
+    """Read an image volume from an array store.
+
+    See `read_image_series` for a description of the parameters.
+    """
+    total_series = store.series_count()
+    if not 0 <= series_id < total_series:
+        raise ValueError("Series ID %i is not between 0 and the total "
+                         "number of series, %i." % (series_id, total_series))
+    return _select_czt(store.read(series_id), store.index['store_order'],
+                       t, z, c, desired_order)
+
+
+def _select_czt(image, stored_order, t, z, c, desired_order):
+    """Select timepoints, planes and channels from a 5D array.
+
+    Parameters
+    ----------
+    image : array, 5 dimensions
+        The full image series.
+    stored_order : string
+        The order of the dimensions of `image`, such as "TZCYX".
+    t, z, c : int, list of int, or None
+        The desired t, z, and c values. `None` means all values are
+        desired. Integer selections are kept as length-1 dimensions,
+        as with BioFormats files.
+    desired_order : string or None
+        Return the image dimensions in this order. `None` means
+        `stored_order`.
+
+    Returns
+    -------
+    image : array, 5 dimensions
+        The selection. This is a view of the input unless `t`, `z` or
+        `c` is a list.
+    """
+    for axis, label in enumerate(stored_order):
+        selection = {'T': t, 'Z': z, 'C': c}.get(label)
+        if selection is None:
+            continue
+        if isinstance(selection, Iterable):
+            image = image.take(list(selection), axis=axis)
+        else:
+            index = [slice(None)] * image.ndim
+            index[axis] = slice(selection, selection + 1)
+            image = image[tuple(index)]
+    if desired_order is not None:
+        image = image.transpose(_get_ordering(stored_order,
+                                              desired_order.upper()))
+    return image
+
+
 def _get_ordering(actual, desired):
     """Find an ordering of indices so that desired[i] == actual[ordering[i]].
 
@@ -391,10 +843,12 @@ def _sanitize_czt(c, z, t, shape, order):
         if dim is None:
             out[label] = range(shape[dim_idx])
         else:
-            if not isinstance(dim, coll.Iterable):
+            if not isinstance(dim, Iterable):
                 out[label] = [dim]
+            else:
+                out[label] = list(dim)
             shape[dim_idx] = len(out[label])
-    czt_order = filter(lambda x: x in 'CZT', order)
+    czt_order = ''.join(x for x in order if x in 'CZT')
     c, z, t = _get_ordering(czt_order, 'CZT')
     czt_list = [(tup[c], tup[z], tup[t])
                 for tup in it.product(*[out[char] for char in czt_order])]
@@ -1,17 +1,21 @@
 """
 Process one or more image files into a set of statistical time series.
 """
-import itertools as it
+import os
 import collections
+import tempfile
 
 import numpy as np
 import pandas as pd
 
+from . import dtypes
+from . import kernels
 from . import lifio
+from . import readers
 from . import trace
 from . import stats
 
-# constants
+# constants; `kernels.trace_stats` computes these statistics, in order
 all_stats = [stats.min_max, stats.slope, stats.missing_fluorescence]
 all_stat_names = ['min_max', 'slope', 'missing']
 
@@ -38,13 +42,55 @@ def bad_image(im):
     return is_bad
 
 
-def traces_dict(fin, series=None, chan=0, return_images=False):
+def _allocate_images(shape, dtype, name, budget, image_dir):
+    """Allocate an array to retain images, spilling to disk if needed.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        The shape of the array.
+    dtype : numpy dtype
+        The data type of the array.
+    name : string
+        The base name of the file backing the array, if one is needed.
+    budget : int or None
+        The number of bytes that may still be allocated in memory. If
+        the array is larger than this, it is backed by a file in
+        `image_dir` instead. ``None`` means no limit.
+    image_dir : string
+        The directory in which to create the backing file.
+
+    Returns
+    -------
+    images : array or numpy memmap
+        The allocated (uninitialised) array.
+    budget : int or None
+        The remaining in-memory budget after this allocation.
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if budget is None or nbytes <= budget:
+        images = np.empty(shape, dtype=dtype)
+        if budget is not None:
+            budget -= nbytes
+    else:
+        filename = os.path.join(image_dir, name + '.npy')
+        images = np.lib.format.open_memmap(filename, mode='w+',
+                                           dtype=dtype, shape=shape)
+    return images, budget
+
+
+def traces_dict(fin, series=None, chan=0, return_images=False,
+                max_image_memory=None, image_dir=None, backend=None,
+                dtype=np.float64, downsample=1):
     """From a LIF file, produce image series, traces, stats.
 
     Parameters
     ----------
-    fin : string
-        The input filename.
+    fin : string, mapping, or readers.Reader
+        The input: a BioFormats (e.g. LIF) filename, an array store
+        written by `lifio.transcode`, a TIFF file or directory of TIFF
+        files, a mapping of series names to arrays, or any source
+        accepted by `readers.get_reader`.
     series : list of int, optional
         Which series to process. ``None`` is interpreted as all
         available series.
@@ -52,7 +98,29 @@ def traces_dict(fin, series=None, chan=0, return_images=False):
         The channel containing the image to be traced.
     return_images : bool, optional
         If ``True``, the images underlying the statistics are returned as
-        part of the traces dictionary.
+        part of the traces dictionary, as one array of shape
+        (ntimes, M, N) per position.
+    max_image_memory : int, optional
+        The maximum number of bytes of returned images to keep in
+        memory. Positions whose images don't fit are written to
+        memory-mapped ``.npy`` files in `image_dir`, and the returned
+        dictionary holds the memory map. ``None`` means no limit.
+        Ignored if `return_images` is ``False``.
+    image_dir : string, optional
+        The directory in which to write images that exceed
+        `max_image_memory`. By default, a new temporary directory is
+        created. The files are not removed by this function.
+    backend : string, optional
+        The name of the reader backend to use for `fin`. By default,
+        it is chosen from the type of `fin`. See `readers.get_reader`.
+    dtype : numpy dtype, optional
+        The floating point type of the traces and of the computation
+        of the statistics. Use ``np.float32`` to halve their memory
+        use. Z projections always use an integer type wide enough to
+        avoid overflow (see `dtypes.projection_dtype`).
+    downsample : int, optional
+        Locate the tube in each frame at this coarser resolution. See
+        `trace.trace_profile`.
 
     Returns
     -------
@@ -63,43 +131,131 @@ def traces_dict(fin, series=None, chan=0, return_images=False):
         The statistics, with rows for each timepoint and columns for
         each position and statistic.
     """
-    names, sizes, resolutions = lifio.metadata(fin)
-    if series is None:
-        series = range(len(names))
-    names, sizes, resolutions = map(lambda x: [x[i] for i in series],
-                                    (names, sizes, resolutions))
-    rdr = lifio.image_reader(fin)
-    all_times = _times(names)
-    positions, times = zip(*map(lifio.parse_series_name, names))
-    positions = sorted(set(positions))
+    rdr = readers.get_reader(fin, backend)
+    index, series = _series_index(rdr, series)
+    all_times = index.unique_times()
+    positions = [int(position) for position in index.positions()]
     traces = collections.OrderedDict()
     ntimes, npositions, nstats = map(len, [all_times, positions, all_stats])
     statistics = (np.empty((ntimes, npositions * nstats), dtype=np.float32) *
                   np.float32(np.nan))
-    statistics = pd.DataFrame(statistics, index=all_times,
-                              columns=it.product(positions, all_stat_names))
-    image_series = lifio.series_iterator(rdr, series,
-                                         desired_order='tzcyx', c=chan)
-
-    for i, (name, images) in enumerate(zip(names, image_series)):
-        images2d = np.squeeze(images.sum(axis=1, dtype=np.uint16)) # squash z
-        if images2d.ndim == 2:
-            images2d = images2d[np.newaxis, ...]
-        position, times = lifio.parse_series_name(name)
-        if not traces.has_key(position):
-            traces[position] = {'times': [], 'traces': [], 'images': []}
-        current_traces = map(trace.trace_profile, images2d)
+    columns = pd.MultiIndex.from_product([positions, all_stat_names])
+    statistics = pd.DataFrame(statistics, index=all_times, columns=columns)
+    image_series = rdr.series_iterator(series, desired_order='tzcyx', c=chan)
+    offsets = collections.defaultdict(int)
+    budget = max_image_memory
+
+    for i, images in enumerate(image_series):
+        images2d = _project_z(images)
+        position, times = int(index.series['position'][i]), index.times(i)
+        if position not in traces:
+            retained = []
+            if return_images:
+                # allocate for the deepest stack of this position
+                position_sizes = index.series['size'][
+                                            index.for_position(position)]
+                retained_dtype = dtypes.projection_dtype(
+                                images.dtype, position_sizes[:, 1].max())
+                shape = ((int(position_sizes[:, 0].sum()),) +
+                         images2d.shape[1:])
+                nbytes = (int(np.prod(shape)) *
+                          np.dtype(retained_dtype).itemsize)
+                if (image_dir is None and budget is not None and
+                        nbytes > budget):
+                    image_dir = tempfile.mkdtemp(prefix='lesion-')
+                retained, budget = _allocate_images(
+                            shape, retained_dtype, 'position-%03i' % position,
+                            budget, image_dir)
+            traces[position] = {'times': [], 'traces': [],
+                                'images': retained}
+        current_traces, current_stats = _trace_frames(images2d, dtype,
+                                                      downsample)
         traces[position]['times'].extend(times)
         traces[position]['traces'].extend(current_traces)
         if return_images:
-            traces[position]['images'].extend(images2d)
-        for tr, time in zip(current_traces, times):
-            for stat, stat_name in zip(all_stats, all_stat_names):
-                statistics.loc[time][(position, stat_name)] = stat(tr)
+            start = offsets[position]
+            offsets[position] += len(images2d)
+            traces[position]['images'][start:offsets[position]] = images2d
+        for values, time in zip(current_stats.astype(np.float32), times):
+            for value, stat_name in zip(values, all_stat_names):
+                statistics.loc[time, (position, stat_name)] = value
 
     return traces, statistics
 
 
+def _series_index(rdr, series=None):
+    """Read the metadata of `rdr` and index the selected series.
+
+    Parameters
+    ----------
+    rdr : readers.Reader
+        The opened input.
+    series : list of int, optional
+        Which series to index. ``None`` is interpreted as all
+        available series.
+
+    Returns
+    -------
+    index : lifio.SeriesIndex
+        The index of the selected series.
+    series : list of int
+        The selected series IDs.
+    """
+    names, sizes, resolutions = rdr.metadata()
+    if series is None:
+        series = range(len(names))
+    series = list(series)
+    names, sizes, resolutions = [[x[i] for i in series]
+                                 for x in (names, sizes, resolutions)]
+    index = lifio.SeriesIndex.from_metadata(names, sizes, resolutions,
+                                            series_ids=series)
+    return index, series
+
+
+def _project_z(images):
+    """Sum a (T, Z, 1, M, N) image series along Z, without overflow.
+
+    Parameters
+    ----------
+    images : array, shape (T, Z, 1, M, N)
+        The image series, with a single channel.
+
+    Returns
+    -------
+    images2d : array, shape (T, M, N)
+        The Z projection of each timepoint.
+    """
+    sum_dtype = dtypes.projection_dtype(images.dtype, images.shape[1])
+    images2d = np.squeeze(images.sum(axis=1, dtype=sum_dtype)) # squash z
+    if images2d.ndim == 2:
+        images2d = images2d[np.newaxis, ...]
+    return images2d
+
+
+def _trace_frames(images2d, dtype=np.float64, downsample=1):
+    """Trace each frame of a projected series and compute its statistics.
+
+    Parameters
+    ----------
+    images2d : array, shape (T, M, N)
+        The projected frames.
+    dtype : numpy dtype, optional
+        The floating point type of the traces and statistics.
+    downsample : int, optional
+        The downsampling factor passed to `trace.trace_profile`.
+
+    Returns
+    -------
+    traces : list of 1D array of float
+        The trace of each frame.
+    values : array of float, shape (T, len(all_stats))
+        The statistics of each trace, in the order of `all_stats`.
+    """
+    traces = [trace.trace_profile(image, dtype=dtype, downsample=downsample)
+              for image in images2d]
+    return traces, kernels.trace_stats(traces, dtype=dtype)
+
+
 def _times(names):
     """Get the set of all unique timepoints represented in `names`.
 
@@ -120,7 +276,4 @@ def _times(names):
     This function assumes there is a one-to-one correspondence between
     start times and unique time series.
     """
-    positions, times = zip(*map(lifio.parse_series_name, names))
-    start_times = [time[0] for time in times]
-    _, indices = np.unique(start_times, return_index=True)
-    return np.unique(np.concatenate([times[i] for i in indices]))
+    return lifio.SeriesIndex.from_metadata(names).unique_times()
@@ -0,0 +1,379 @@
+"""
+Reader backends: a common interface to image series stored in
+BioFormats files, `lifio` array stores, TIFF stacks, or in memory.
+
+Heavy dependencies (javabridge, bioformats, tifffile) are only imported
+when a backend that needs them is first used.
+"""
+import os
+import collections
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+import numpy as np
+
+from . import lifio
+
+
+READERS = collections.OrderedDict()
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def register_reader(name):
+    """Class decorator adding a `Reader` subclass to the registry.
+
+    Parameters
+    ----------
+    name : string
+        The name by which the backend can be requested, for example in
+        ``get_reader(source, backend=name)``.
+
+    Returns
+    -------
+    decorator : function
+        A function that registers and returns its class argument.
+
+    Notes
+    -----
+    When no backend is requested, `get_reader` tries the registered
+    backends from the most recently registered to the first, so later
+    registrations take precedence.
+    """
+    def decorator(cls):
+        cls.name = name
+        READERS[name] = cls
+        return cls
+    return decorator
+
+
+def get_reader(source, backend=None):
+    """Open `source` with the requested or most appropriate backend.
+
+    Parameters
+    ----------
+    source : string, mapping, or Reader
+        The image source: for example, a LIF filename, the path to an
+        array store, a TIFF file or directory, or a dictionary mapping
+        series names to arrays. A `Reader` is returned unchanged.
+    backend : string, optional
+        The name of a registered backend, such as 'bioformats',
+        'store', 'tiff', or 'numpy'. By default, it is chosen from the
+        type of `source`.
+
+    Returns
+    -------
+    rdr : Reader
+        The opened reader.
+    """
+    if isinstance(source, Reader):
+        return source
+    if backend is not None:
+        if backend not in READERS:
+            raise ValueError("Unknown reader backend: %s. Available "
+                             "backends are: %s." %
+                             (backend, ', '.join(READERS)))
+        return READERS[backend](source)
+    for cls in reversed(list(READERS.values())):
+        if cls.accepts(source):
+            return cls(source)
+    if isinstance(source, str) and os.path.isdir(source):
+        raise ValueError("The directory %s is neither an array store (it "
+                         "has no index.json; was it written completely?) "
+                         "nor contains any TIFF files." % source)
+    raise ValueError("No reader backend accepts the source: %r" % (source,))
+
+
+class Reader(object):
+    """Base class for reader backends.
+
+    Subclasses must implement `accepts`, `series_count`, `metadata`,
+    and `read_image_series`, with the same semantics as the functions
+    of the same name in `lifio`.
+
+    Parameters
+    ----------
+    source : object
+        The image source.
+    """
+    name = None
+
+    def __init__(self, source):
+        self.source = source
+
+    @classmethod
+    def accepts(cls, source):
+        """Return ``True`` if this backend can read `source`."""
+        return False
+
+    def series_count(self):
+        """Return the number of image series in the source."""
+        raise NotImplementedError
+
+    def metadata(self, array_order=lifio.DEFAULT_DIM_ORDER):
+        """Return the names, sizes and resolutions of all series.
+
+        See `lifio.metadata` for details.
+        """
+        raise NotImplementedError
+
+    def read_image_series(self, series_id=0, t=None, z=None, c=None,
+                          desired_order=None):
+        """Read an image volume. See `lifio.read_image_series`."""
+        raise NotImplementedError
+
+    def series_iterator(self, series=None, **kwargs):
+        """Iterate over all the series in the source.
+
+        Parameters
+        ----------
+        series : iterable of int, optional
+            Limit the iteration to the specified series.
+        **kwargs : keyword arguments, optional
+            Keyword arguments to be passed on to `read_image_series`.
+
+        Returns
+        -------
+        seit : iterator
+            Iterator over the series.
+        """
+        if series is None:
+            series = range(self.series_count())
+        for series_id in series:
+            yield self.read_image_series(series_id, **kwargs)
+
+
+@register_reader('bioformats')
+class BioformatsReader(Reader):
+    """Read any BioFormats file, such as LIF, through the JVM.
+
+    This is the fallback backend for any file that no other backend
+    accepts. Directories are not BioFormats files, and are refused.
+    The JVM is started when the file is first read.
+    """
+    def __init__(self, source):
+        Reader.__init__(self, source)
+        self._rdr = None
+
+    @classmethod
+    def accepts(cls, source):
+        try:
+            return not os.path.isdir(source)
+        except (TypeError, AttributeError):
+            return True
+
+    @property
+    def rdr(self):
+        if self._rdr is None:
+            self._rdr = lifio.image_reader(self.source)
+        return self._rdr
+
+    def series_count(self):
+        return self.rdr.rdr.getSeriesCount()
+
+    def metadata(self, array_order=lifio.DEFAULT_DIM_ORDER):
+        return lifio.metadata(self.source, array_order)
+
+    def read_image_series(self, series_id=0, t=None, z=None, c=None,
+                          desired_order=None):
+        return lifio.read_image_series(self.rdr, series_id, t, z, c,
+                                       desired_order)
+
+
+@register_reader('tiff')
+class TiffReader(Reader):
+    """Read TIFF stacks, one series per file.
+
+    The source is either a single TIFF file or a directory, which is
+    searched recursively for TIFF files. The name of each series is
+    the path of its file relative to the directory, without extension,
+    so a layout such as ``22.5h to 41h pSCI/Pos013_S001.tif`` is
+    understood by `lifio.parse_series_name`.
+
+    Stacks are interpreted as (Y, X), (Z, Y, X), (T, Z, Y, X) or
+    (T, Z, C, Y, X) depending on their number of dimensions. TIFF
+    files don't record physical resolution consistently, so all
+    resolutions are reported as 1.0.
+
+    Requires the `tifffile` package.
+    """
+    def __init__(self, source):
+        Reader.__init__(self, source)
+        if os.path.isdir(source):
+            self.filenames = _tiff_files(source)
+            if not self.filenames:
+                raise ValueError("No TIFF files found in directory %s."
+                                 % source)
+            self.names = [os.path.splitext(
+                                os.path.relpath(f, source))[0].replace(
+                                                            os.sep, '/')
+                          for f in self.filenames]
+        else:
+            self.filenames = [source]
+            self.names = [os.path.splitext(os.path.basename(source))[0]]
+
+    @classmethod
+    def accepts(cls, source):
+        try:
+            if os.path.isdir(source):
+                return len(_tiff_files(source, limit=1)) > 0
+            return _is_tiff(source)
+        except (TypeError, AttributeError):
+            return False
+
+    def series_count(self):
+        return len(self.filenames)
+
+    def metadata(self, array_order=lifio.DEFAULT_DIM_ORDER):
+        import tifffile
+        sizes, resolutions = [], []
+        nspatial = len([d for d in array_order if d.upper() in 'XYZ'])
+        for filename in self.filenames:
+            with tifffile.TiffFile(filename) as tif:
+                shape = _tzcyx_shape(tif.series[0].shape)
+            sizes.append(_sizes(shape, array_order))
+            resolutions.append((1.0,) * nspatial)
+        return list(self.names), sizes, resolutions
+
+    def read_image_series(self, series_id=0, t=None, z=None, c=None,
+                          desired_order=None):
+        import tifffile
+        _check_series_id(series_id, self.series_count())
+        image = tifffile.imread(self.filenames[series_id])
+        image = image.reshape(_tzcyx_shape(image.shape))
+        return lifio._select_czt(image, lifio.STORE_ORDER, t, z, c,
+                                 desired_order)
+
+
+@register_reader('store')
+class StoreReader(Reader):
+    """Read an array store written by `lifio.transcode`."""
+    def __init__(self, source):
+        Reader.__init__(self, source)
+        self.store = lifio.image_reader(source)
+
+    @classmethod
+    def accepts(cls, source):
+        return lifio.is_store(source)
+
+    def series_count(self):
+        return self.store.series_count()
+
+    def metadata(self, array_order=lifio.DEFAULT_DIM_ORDER):
+        return self.store.metadata(array_order)
+
+    def read_image_series(self, series_id=0, t=None, z=None, c=None,
+                          desired_order=None):
+        return lifio.read_image_series(self.store, series_id, t, z, c,
+                                       desired_order)
+
+
+@register_reader('numpy')
+class NumpyReader(Reader):
+    """Read image series held in memory.
+
+    The source is a mapping from series names to arrays, in iteration
+    order (use an `OrderedDict` to control it). Arrays are interpreted
+    as (Y, X), (Z, Y, X), (T, Z, Y, X) or (T, Z, C, Y, X) depending on
+    their number of dimensions. All resolutions are reported as 1.0.
+    """
+    def __init__(self, source):
+        Reader.__init__(self, source)
+        self.names = list(source)
+        self.images = [np.asarray(source[name]) for name in self.names]
+
+    @classmethod
+    def accepts(cls, source):
+        return isinstance(source, Mapping)
+
+    def series_count(self):
+        return len(self.names)
+
+    def metadata(self, array_order=lifio.DEFAULT_DIM_ORDER):
+        nspatial = len([d for d in array_order if d.upper() in 'XYZ'])
+        sizes = [_sizes(_tzcyx_shape(image.shape), array_order)
+                 for image in self.images]
+        resolutions = [(1.0,) * nspatial] * len(self.images)
+        return list(self.names), sizes, resolutions
+
+    def read_image_series(self, series_id=0, t=None, z=None, c=None,
+                          desired_order=None):
+        _check_series_id(series_id, self.series_count())
+        image = self.images[series_id]
+        image = image.reshape(_tzcyx_shape(image.shape))
+        return lifio._select_czt(image, lifio.STORE_ORDER, t, z, c,
+                                 desired_order)
+
+
+def _is_tiff(filename):
+    """Return ``True`` if `filename` has a TIFF extension."""
+    return os.path.splitext(filename)[1].lower() in TIFF_EXTENSIONS
+
+
+def _tiff_files(directory, limit=None):
+    """Find the TIFF files in `directory` and its subdirectories.
+
+    Parameters
+    ----------
+    directory : string
+        The directory to search.
+    limit : int, optional
+        Stop searching once this many files have been found.
+
+    Returns
+    -------
+    filenames : list of string
+        The sorted paths of the TIFF files found.
+    """
+    filenames = []
+    for root, dirs, files in os.walk(directory):
+        filenames.extend(os.path.join(root, f) for f in files if _is_tiff(f))
+        if limit is not None and len(filenames) >= limit:
+            break
+    return sorted(filenames)
+
+
+def _check_series_id(series_id, total_series):
+    """Raise a ValueError if `series_id` is out of range."""
+    if not 0 <= series_id < total_series:
+        raise ValueError("Series ID %i is not between 0 and the total "
+                         "number of series, %i." % (series_id, total_series))
+
+
+def _tzcyx_shape(shape):
+    """Expand the shape of a 2-5D stack to (T, Z, C, Y, X).
+
+    Examples
+    --------
+    >>> _tzcyx_shape((512, 512))
+    (1, 1, 1, 512, 512)
+    >>> _tzcyx_shape((25, 512, 512))
+    (1, 25, 1, 512, 512)
+    >>> _tzcyx_shape((3, 25, 512, 512))
+    (3, 25, 1, 512, 512)
+    """
+    shape = tuple(shape)
+    if len(shape) == 2:
+        return (1, 1, 1) + shape
+    elif len(shape) == 3:
+        return (1, shape[0], 1) + shape[1:]
+    elif len(shape) == 4:
+        return shape[:2] + (1,) + shape[2:]
+    elif len(shape) == 5:
+        return shape
+    else:
+        raise ValueError("Cannot interpret a %i-dimensional stack as "
+                         "an image series." % len(shape))
+
+
+def _sizes(tzcyx_shape, array_order):
+    """Reorder a (T, Z, C, Y, X) shape into `array_order`.
+
+    Examples
+    --------
+    >>> _sizes((3, 25, 1, 512, 256), 'tzyxc')
+    (3, 25, 512, 256, 1)
+    """
+    return tuple([tzcyx_shape[lifio.STORE_ORDER.find(d)]
+                  for d in array_order.upper()])
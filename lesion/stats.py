@@ -6,6 +6,8 @@ statistic is min/max, but others will be compiled here.
 import numpy as np
 from scipy import ndimage as nd
 
+from . import dtypes
+
 
 def min_max(tr):
     """Return the ratio of minimum to maximum of a trace.
@@ -13,7 +15,8 @@ def min_max(tr):
     Parameters
     ----------
     tr : 1D array of float
-        The input profile.
+        The input profile. Floating point profiles are used in their
+        own precision; others are converted to float64.
 
     Returns
     -------
@@ -26,7 +29,7 @@ def min_max(tr):
     >>> min_max(tr) # doctest: +ELLIPSIS
     0.4...
     """
-    tr = tr.astype(float)
+    tr = dtypes.as_float(tr)
     mm = tr.min() / tr.max()
     return mm
 
@@ -37,7 +40,8 @@ def slope(tr, sigma=None):
     Parameters
     ----------
     tr : 1D array of float
-        The input profile.
+        The input profile. Floating point profiles are used in their
+        own precision; others are converted to float64.
     sigma : float, optional
         Smooth `tr` by a Gaussian filter with this sigma.
 
@@ -54,7 +58,7 @@ def slope(tr, sigma=None):
     >>> slope(tr, sigma=1) # doctest: +ELLIPSIS
     0.7556...
     """
-    tr = tr.astype(float)
+    tr = dtypes.as_float(tr)
     if sigma is not None:
         tr = nd.gaussian_filter1d(tr, sigma=sigma)
     m, M = np.argmin(tr), np.argmax(tr)
@@ -68,7 +72,8 @@ def missing_fluorescence(tr, sigma=None, height=None, margins=50):
     Parameters
     ----------
     tr : 1D array of float
-        The input profile.
+        The input profile. Floating point profiles are used in their
+        own precision; others are converted to float64.
     sigma : float, optional
         Smooth `tr` by a Gaussian filter with this sigma.
     height : float, optional
@@ -96,7 +101,7 @@ def missing_fluorescence(tr, sigma=None, height=None, margins=50):
     >>> np.round(missing_fluorescence(tr, sigma=1, margins=3), decimals=2)
     12.56
     """
-    tr = tr.astype(float)
+    tr = dtypes.as_float(tr)
     if height is None:
         height = np.mean(tr[:margins] + tr[-margins:]) / 2
     if sigma is not None:
@@ -104,3 +109,166 @@ def missing_fluorescence(tr, sigma=None, height=None, margins=50):
     tr = np.clip(tr, 0, height)
     m = (height - tr).sum()
     return m
+
+
+def fit_recovery(statistics, rates=None, min_time=0.):
+    """Fit an exponential recovery curve to every column of a table.
+
+    Each column is fitted with the model::
+
+        y(t) = plateau + amplitude * exp(-rate * (t - start_time))
+
+    where ``start_time`` is the column's first fitted timepoint. It is
+    fitted by linear least squares for `plateau` and `amplitude` at each
+    candidate `rate`, keeping the rate with the lowest residual. All
+    columns and rates are solved at once, and missing (NaN) values are
+    simply left out of each column's fit.
+
+    Parameters
+    ----------
+    statistics : pandas DataFrame
+        The time series to fit, with timepoints as the index and one
+        column per time series, as returned by
+        `process.traces_dict`.
+    rates : array of float, optional
+        The candidate rates, in inverse units of the index. By default,
+        512 rates log-spaced between one tenth of the inverse of the
+        fitted time span and ten times the inverse of the smallest
+        time step.
+    min_time : float, optional
+        Leave out timepoints before this one. By default, the "Pre"
+        and "Mark" timepoints (-1 and -2) are left out.
+
+    Returns
+    -------
+    fits : pandas DataFrame
+        One row per column of `statistics`, with the fitted
+        ``plateau``, ``amplitude`` and ``rate``, the recovery
+        ``half_time`` (``log(2) / rate``), the residual sum of squares
+        ``rss``, the first fitted timepoint ``start_time``, at which
+        the curve equals ``plateau + amplitude``, and the number of
+        points fitted, ``npoints``. Fits with fewer than three points
+        are NaN.
+
+    Examples
+    --------
+    >>> import pandas as pd
+    >>> t = np.arange(0, 24, 0.5)
+    >>> table = pd.DataFrame({'a': 1 - 0.5 * np.exp(-np.log(2) / 4 * t),
+    ...                       'b': 2 + np.exp(-np.log(2) / 10 * t)},
+    ...                      index=t)
+    >>> table.iloc[[3, 10, 11], 0] = np.nan
+    >>> fits = fit_recovery(table)
+    >>> np.round(fits['half_time'].values, 1)
+    array([  4.,  10.])
+    >>> np.round(fits[['plateau', 'amplitude', 'start_time']].values, 2)
+    array([[ 1. , -0.5,  0. ],
+           [ 2. ,  1. ,  0. ]])
+    """
+    import pandas as pd
+    times = np.asarray(statistics.index, dtype=float)
+    values = np.asarray(statistics.values, dtype=float)
+    keep = times >= min_time
+    times, values = times[keep], values[keep]
+    if rates is None:
+        steps = np.diff(np.unique(times))
+        span = times.max() - times.min() if len(times) > 1 else 1.
+        smallest_step = steps.min() if len(steps) > 0 else 1.
+        rates = np.logspace(np.log10(0.1 / span),
+                            np.log10(10. / smallest_step), 512)
+    rates = np.asarray(rates, dtype=float)
+
+    valid = ~np.isnan(values)
+    weights = valid.astype(float)
+    s0 = weights.sum(axis=0)
+    # fit each column around its mean, so that the residual sum of
+    # squares doesn't cancel catastrophically for large, flat signals
+    mean = np.where(valid, values, 0).sum(axis=0) / np.maximum(s0, 1)
+    y = np.where(valid, values - mean, 0)
+    # relative times keep exp(-rate * t) in range
+    t0 = times.min() if len(times) > 0 else 0.
+    basis = np.exp(-rates[:, np.newaxis] * (times - t0))  # (nrates, ntimes)
+    sy, syy = y.sum(axis=0), (y ** 2).sum(axis=0)
+    plateau, amplitude, rss = _exponential_lstsq(
+                    s0, np.dot(basis, weights), np.dot(basis ** 2, weights),
+                    sy, np.dot(basis, y), syy)
+    columns = np.arange(values.shape[1])
+    best = rss.argmin(axis=0)
+    best_rss = rss[best, columns]
+    best_rate = rates[best]
+    plateau, amplitude = plateau[best, columns], amplitude[best, columns]
+
+    # refine each rate to the vertex of a parabola through the residuals
+    # at its neighbouring rates, in log space
+    inner = (best > 0) & (best < len(rates) - 1)
+    x = np.log(rates)
+    lo, hi = np.maximum(best - 1, 0), np.minimum(best + 1, len(rates) - 1)
+    x0, x1, x2 = x[lo], x[best], x[hi]
+    y0, y1, y2 = rss[lo, columns], best_rss, rss[hi, columns]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        numer = ((x1 - x0) ** 2 * (y1 - y2) - (x1 - x2) ** 2 * (y1 - y0))
+        denom = ((x1 - x0) * (y1 - y2) - (x1 - x2) * (y1 - y0))
+        refined_rate = np.exp(x1 - 0.5 * numer / denom)
+    inner &= np.isfinite(refined_rate)
+    refined_rate = np.where(inner, refined_rate, best_rate)
+    refined_basis = np.exp(-refined_rate * (times - t0)[:, np.newaxis])
+    refined = _exponential_lstsq(
+                    s0, (refined_basis * weights).sum(axis=0),
+                    (refined_basis ** 2 * weights).sum(axis=0), sy,
+                    (refined_basis * y).sum(axis=0), syy)
+    better = inner & (refined[2] < best_rss)
+    best_rate = np.where(better, refined_rate, best_rate)
+    plateau = np.where(better, refined[0], plateau)
+    amplitude = np.where(better, refined[1], amplitude)
+    best_rss = np.where(better, refined[2], best_rss)
+    failed = (s0 < 3) | np.isinf(best_rss)
+
+    # the sums above are good enough to pick the rate, but recompute the
+    # residuals directly for the chosen one
+    with np.errstate(invalid='ignore'):
+        best_basis = np.exp(-best_rate * (times - t0)[:, np.newaxis])
+        residuals = y - plateau - amplitude * best_basis
+        rss = (np.where(valid, residuals, 0) ** 2).sum(axis=0)
+        # report the amplitude at each column's first fitted timepoint
+        start_time = np.where(valid, times[:, np.newaxis], np.inf).min(axis=0)
+        amplitude = amplitude * np.exp(-best_rate * (start_time - t0))
+    fits = {'plateau': plateau + mean,
+            'amplitude': amplitude,
+            'rate': best_rate,
+            'half_time': np.log(2) / best_rate,
+            'rss': rss,
+            'start_time': np.where(s0 > 0, start_time, np.nan),
+            'npoints': s0.astype(int)}
+    for name in ['plateau', 'amplitude', 'rate', 'half_time', 'rss']:
+        fits[name] = np.where(failed, np.nan, fits[name])
+    return pd.DataFrame(fits, index=statistics.columns,
+                        columns=['plateau', 'amplitude', 'rate',
+                                 'half_time', 'rss', 'start_time',
+                                 'npoints'])
+
+
+def _exponential_lstsq(s0, s1, s2, sy, sey, syy):
+    """Solve the 2x2 normal equations of ``y = plateau + amplitude * e``.
+
+    Parameters
+    ----------
+    s0, s1, s2 : arrays of float
+        The number of points, and the sums of ``e`` and ``e ** 2``.
+    sy, sey, syy : arrays of float
+        The sums of ``y``, ``e * y``, and ``y ** 2``.
+
+    Returns
+    -------
+    plateau, amplitude : arrays of float
+        The least squares parameters.
+    rss : array of float
+        The residual sum of squares, or infinity where the equations
+        are singular.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = s0 * s2 - s1 ** 2
+        amplitude = (s0 * sey - s1 * sy) / det
+        plateau = (sy - amplitude * s1) / s0
+        rss = syy - plateau * sy - amplitude * sey
+    rss = np.where(np.isfinite(rss) & (det > 0), rss, np.inf)
+    return plateau, amplitude, rss
@@ -0,0 +1,148 @@
+"""
+Stream traces and statistics to asyncio code as each series finishes.
+
+This module requires Python 3.7 or later. Blocking reads and tracing
+run in a thread pool, so the event loop stays responsive, and at most
+a fixed number of series are read ahead of the consumer.
+"""
+import asyncio
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import lifio
+from . import process
+from . import readers
+
+
+async def aprocess(fin, series=None, chan=0, backend=None,
+                   dtype=np.float64, downsample=1, max_workers=2,
+                   max_pending=2, executor=None):
+    """Asynchronously produce traces and statistics, one frame at a time.
+
+    Parameters
+    ----------
+    fin : string, mapping, or readers.Reader
+        The input. See `process.traces_dict`.
+    series : list of int, optional
+        Which series to process. ``None`` is interpreted as all
+        available series.
+    chan : int, optional
+        The channel containing the image to be traced.
+    backend : string, optional
+        The name of the reader backend to use for `fin`.
+    dtype : numpy dtype, optional
+        The floating point type of the traces and statistics.
+    downsample : int, optional
+        Locate the tube in each frame at this coarser resolution. See
+        `trace.trace_profile`.
+    max_workers : int, optional
+        The number of threads tracing series concurrently. Ignored if
+        `executor` is given.
+    max_pending : int, optional
+        The maximum number of series being read or traced ahead of the
+        consumer. This bounds memory use when the consumer is slow.
+    executor : concurrent.futures.Executor, optional
+        Run blocking work in this executor instead of a new thread
+        pool. It is not shut down when the stream ends.
+
+    Yields
+    ------
+    position : int
+        The position of the embryo on the slide.
+    time : float
+        The timepoint of the frame.
+    trace : 1D array of float
+        The intensity profile of the frame.
+    stats : OrderedDict
+        The value of each statistic in `process.all_stat_names`.
+
+    Notes
+    -----
+    Frames are produced in series order, and within a series in time
+    order, as soon as their series has been traced. If the consuming
+    task is cancelled or the generator is closed, series not yet
+    started are cancelled.
+
+    Reads are serialized, since readers are not thread-safe. While
+    reading BioFormats files, the reading thread is attached to the
+    JVM; it is detached after each read.
+
+    Examples
+    --------
+    >>> async def first_result(fin):
+    ...     async for position, time, trace, stats in aprocess(fin):
+    ...         return position, time, stats['min_max']
+    """
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers)
+    rdr = readers.get_reader(fin, backend)
+    read_lock = threading.Lock()
+    pending = collections.deque()
+    try:
+        index, series = await loop.run_in_executor(
+                        executor, _locked, read_lock, rdr,
+                        process._series_index, rdr, series)
+        jobs = iter(enumerate(series))
+
+        def submit():
+            job = next(jobs, None)
+            if job is not None:
+                i, series_id = job
+                future = loop.run_in_executor(executor, _process_series,
+                                              rdr, read_lock, series_id,
+                                              chan, dtype, downsample)
+                pending.append((i, future))
+
+        for _ in range(max_pending):
+            submit()
+        while pending:
+            i, future = pending.popleft()
+            traces, values = await future
+            submit()
+            position = int(index.series['position'][i])
+            for time, tr, tr_values in zip(index.times(i), traces, values):
+                stats = collections.OrderedDict(
+                                zip(process.all_stat_names, tr_values))
+                yield position, float(time), tr, stats
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+def _locked(lock, rdr, func, *args):
+    """Call ``func(*args)`` on `rdr`'s behalf while holding `lock`.
+
+    If `rdr` reads through the JVM, the current thread is attached to
+    it for the duration of the call.
+    """
+    with lock:
+        if not isinstance(rdr, readers.BioformatsReader):
+            return func(*args)
+        lifio.attach_thread()
+        try:
+            return func(*args)
+        finally:
+            lifio.detach_thread()
+
+
+def _process_series(rdr, read_lock, series_id, chan, dtype, downsample=1):
+    """Read, project, and trace one series.
+
+    Returns
+    -------
+    traces : list of 1D array of float
+        The trace of each frame.
+    values : array of float, shape (T, len(process.all_stats))
+        The statistics of each trace.
+    """
+    images = _locked(read_lock, rdr, rdr.read_image_series, series_id,
+                     None, None, chan, 'tzcyx')
+    return process._trace_frames(process._project_z(images), dtype,
+                                 downsample)
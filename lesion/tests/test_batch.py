@@ -0,0 +1,126 @@
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose
+
+from lesion import batch, lifio, process
+
+
+def _toy_store(path):
+    tube = np.zeros((2, 48, 32), np.uint16)
+    tube[..., 10:22] = 300
+    lesioned = tube.copy()
+    lesioned[:, 20:28] //= 3
+    names, images = [], []
+    for position in range(1, 4):
+        names.append('Pre lesion 2x/Pos%03i_S001' % position)
+        images.append(tube[np.newaxis, :, np.newaxis])
+        names.append('1h to 2h pSCI/Pos%03i_S001' % position)
+        images.append(np.array([lesioned] * 3)[:, :, np.newaxis])
+    sizes = [(im.shape[0], im.shape[1], im.shape[3], im.shape[4], 1)
+             for im in images]
+    resolutions = [(1., 1., 1.)] * len(names)
+    return lifio.write_store(path, names, sizes, resolutions, images)
+
+
+def test_workers_share_queue():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = os.path.join(tmpdir, 'store')
+        root = os.path.join(tmpdir, 'queue')
+        _toy_store(store)
+        units = batch.enqueue(root, store, unit_size=2)
+        assert len(units) == 3
+        workers = [multiprocessing.Process(target=batch.work, args=(root,),
+                                           kwargs={'poll': 0.1})
+                   for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert_equal(sorted(os.listdir(os.path.join(root, 'done'))), units)
+        assert_equal(os.listdir(os.path.join(root, 'pending')), [])
+        assert_equal(os.listdir(os.path.join(root, 'claimed')), [])
+        statistics = batch.collect(root)[os.path.abspath(store)]
+        _, expected = process.traces_dict(store)
+        assert_equal(list(statistics.index), list(expected.index))
+        assert_equal(list(statistics.columns),
+                     list(expected.sort_index(axis=1).columns))
+        assert_allclose(statistics.values,
+                        expected.sort_index(axis=1).values)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_stale_claims_are_requeued():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = os.path.join(tmpdir, 'store')
+        root = os.path.join(tmpdir, 'queue')
+        _toy_store(store)
+        units = batch.enqueue(root, store, unit_size=6)
+        dead = batch.claim(root, 'dead-worker')
+        assert batch.claim(root, 'other-worker') is None
+        assert_equal(batch.requeue_stale(root, timeout=60), [])
+        an_hour_ago = time.time() - 3600
+        os.utime(dead, (an_hour_ago, an_hour_ago))
+        assert_equal(batch.requeue_stale(root, timeout=60), units)
+        assert_equal(batch.work(root, 'live-worker'), units)
+        assert_equal(os.listdir(os.path.join(root, 'done')), units)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_failed_units_are_set_aside():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = os.path.join(tmpdir, 'store')
+        root = os.path.join(tmpdir, 'queue')
+        images = [np.ones((1, 2, 1, 8, 8), np.uint16)] * 2
+        names = ['1h to 2h pSCI/Pos001_S001', 'not a series name']
+        lifio.write_store(store, names, [(1, 2, 8, 8, 1)] * 2,
+                          [(1., 1., 1.)] * 2, images)
+        units = batch.enqueue(root, store, unit_size=1)
+        assert_equal(batch.work(root, 'worker', poll=0.1), units[:1])
+        assert_equal(os.listdir(os.path.join(root, 'done')), units[:1])
+        error = units[1][:-len('.json')] + '.err'
+        assert_equal(sorted(os.listdir(os.path.join(root, 'failed'))),
+                     [error, units[1]])
+        assert_equal(os.listdir(os.path.join(root, 'claimed')), [])
+        with open(os.path.join(root, 'failed', error)) as fin:
+            assert 'Traceback' in fin.read()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_files_with_the_same_name_are_kept_apart():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        root = os.path.join(tmpdir, 'queue')
+        stores = [os.path.join(tmpdir, d, 'store') for d in ['a', 'b']]
+        _toy_store(stores[0])
+        # same name and positions, different values
+        names, sizes, resolutions = lifio.metadata(stores[0])
+        images = [np.ones((s[0], s[1], 1, s[2], s[3]), np.uint16)
+                  for s in sizes]
+        for image in images:
+            image[..., 8:24] = 100
+        lifio.write_store(stores[1], names, sizes, resolutions, images)
+        units = [batch.enqueue(root, store, unit_size=6) for store in stores]
+        assert units[0] != units[1]
+        assert_equal(len(os.listdir(os.path.join(root, 'pending'))), 2)
+        batch.work(root, 'worker')
+        statistics = batch.collect(root)
+        for store in stores:
+            _, expected = process.traces_dict(store)
+            expected = expected.sort_index(axis=1)
+            assert_allclose(statistics[os.path.abspath(store)].values,
+                            expected.values)
+            assert_allclose(batch.collect(root, store).values,
+                            expected.values)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,89 @@
+import sys
+import subprocess
+
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose
+
+from lesion import kernels, trace
+
+
+def _compare(func, *args):
+    """Run `func` with the compiled and reference paths.
+
+    Without Numba, the "compiled" path runs the same loops in Python.
+    """
+    use_numba = kernels.USE_NUMBA
+    try:
+        kernels.USE_NUMBA = True
+        compiled = func(*args)
+        kernels.USE_NUMBA = False
+        reference = func(*args)
+    finally:
+        kernels.USE_NUMBA = use_numba
+    return compiled, reference
+
+
+def test_mode_width_equivalence():
+    random = np.random.RandomState(0)
+    distributions = random.randint(0, 1000, size=(20, 64))
+    distributions[3] = 7  # flat distribution: first index is the mode
+    (modes, whms), (ref_modes, ref_whms) = _compare(kernels.mode_width,
+                                                    distributions)
+    assert_equal(modes, ref_modes)
+    assert_equal(whms, ref_whms)
+    for d, mode, whm in zip(distributions, modes, whms):
+        assert_equal((mode, whm), trace.estimate_mode_width(d))
+
+
+def test_profile_line_equivalence():
+    random = np.random.RandomState(0)
+    image = random.randint(0, 4096, size=(97, 64)).astype(np.uint16)
+    lines = [((0, 10), (96, 50), 9), ((0, 50), (96, 3), 14),
+             ((0, 31.5), (96, 31.5), 1), ((0, 0), (96, 63), 30),
+             ((5, 5), (5, 5), 3)]
+    for src, dst, width in lines:
+        compiled, reference = _compare(kernels.profile_line, image, src, dst,
+                                       width)
+        assert_allclose(compiled, reference, rtol=1e-10)
+
+
+def test_trace_stats_equivalence():
+    random = np.random.RandomState(0)
+    traces = [random.uniform(0, 100, size=n) for n in [5, 49, 50, 120, 400]]
+    traces.append(np.zeros(30))
+    traces.append(np.array([3, 5, 4, 0, 2, 2, 0, 3, 4, 5]))
+    compiled, reference = _compare(kernels.trace_stats, traces)
+    assert_allclose(compiled, reference, rtol=1e-10)
+
+
+def test_trace_profile_equivalence():
+    rows, cols = np.mgrid[:128, :96]
+    image = 500 * np.exp(-(cols - 30 - rows / 4.) ** 2 / 50.)
+    compiled, reference = _compare(trace.trace_profile, image)
+    assert_allclose(compiled, reference, rtol=1e-10)
+
+
+def test_float32_outputs():
+    image = np.random.RandomState(0).uniform(size=(40, 30))
+    for use_numba in [True, False]:
+        kernels.USE_NUMBA, use_numba = use_numba, kernels.USE_NUMBA
+        try:
+            profile = kernels.profile_line(image, (0, 5), (39, 20), 5,
+                                           dtype=np.float32)
+            values = kernels.trace_stats([profile], dtype=np.float32)
+        finally:
+            kernels.USE_NUMBA = use_numba
+        assert profile.dtype == np.float32
+        assert values.dtype == np.float32
+
+
+def test_lazy_numba_import():
+    code = ("import sys, lesion.trace, lesion.process; "
+            "sys.exit('numba' in sys.modules)")
+    assert subprocess.call([sys.executable, '-c', code]) == 0
+
+
+def test_lazy_skimage_import():
+    code = ("import sys, lesion.trace, lesion.stats; "
+            "sys.exit('skimage' in sys.modules)")
+    assert subprocess.call([sys.executable, '-c', code]) == 0
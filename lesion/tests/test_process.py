@@ -1,3 +1,7 @@
+import os
+import shutil
+import tempfile
+import collections
 import numpy as np
 from lesion import process
 
@@ -7,3 +11,114 @@ def test_bad_image():
     assert process.bad_image(im)
     im[32, :] = 6554
     assert not process.bad_image(im)
+
+
+def test_allocate_images_spills_to_disk():
+    image_dir = tempfile.mkdtemp()
+    try:
+        small, budget = process._allocate_images((2, 8, 8), np.uint16,
+                                                 'small', 300, image_dir)
+        assert not isinstance(small, np.memmap)
+        assert budget == 300 - 2 * 8 * 8 * 2
+        large, budget = process._allocate_images((2, 8, 8), np.uint16,
+                                                 'large', budget, image_dir)
+        assert isinstance(large, np.memmap)
+        large[:] = 7
+        large.flush()
+        reloaded = np.load(os.path.join(image_dir, 'large.npy'),
+                           mmap_mode='r')
+        assert reloaded.shape == (2, 8, 8)
+        assert np.all(reloaded == 7)
+    finally:
+        shutil.rmtree(image_dir)
+
+
+def test_allocate_images_unlimited():
+    images, budget = process._allocate_images((3, 4, 4), np.uint16,
+                                              'any', None, None)
+    assert images.shape == (3, 4, 4)
+    assert budget is None
+
+
+def test_traces_dict_numpy_backend():
+    tube = np.zeros((4, 64, 32), np.uint16)
+    tube[..., 12:20] = 200
+    images = collections.OrderedDict()
+    images['Pre lesion 2x/Pos001_S001'] = tube
+    images['1h to 2h pSCI/Pos001_S001'] = np.array([tube] * 3)
+    images['1h to 2h pSCI/Pos002_S001'] = np.array([tube] * 3)
+    traces, statistics = process.traces_dict(images, return_images=True)
+    assert list(traces) == [1, 2]
+    assert traces[1]['images'].shape == (4, 64, 32)
+    assert len(traces[2]['traces']) == 3
+    assert list(statistics.index) == [-1., 1., 1.5, 2.]
+    assert np.isnan(statistics.loc[-1.][(2, 'min_max')])
+    assert statistics.loc[1.5][(1, 'min_max')] == 1
+
+
+def test_traces_dict_spills_images_to_disk():
+    tube = np.zeros((4, 64, 32), np.uint16)
+    tube[..., 12:20] = 200
+    tube[:, ::8] += 7
+    images = collections.OrderedDict()
+    images['Pre lesion 2x/Pos001_S001'] = tube
+    images['1h to 2h pSCI/Pos001_S001'] = np.array([tube] * 3)
+    images['1h to 2h pSCI/Pos002_S001'] = np.array([tube + 1] * 3)
+    expected, _ = process.traces_dict(images, return_images=True)
+    # room for position 1, but not position 2
+    max_image_memory = expected[1]['images'].nbytes
+    image_dir = tempfile.mkdtemp()
+    try:
+        traces, statistics = process.traces_dict(
+                                images, return_images=True,
+                                max_image_memory=max_image_memory,
+                                image_dir=image_dir)
+        assert not isinstance(traces[1]['images'], np.memmap)
+        assert isinstance(traces[2]['images'], np.memmap)
+        assert os.listdir(image_dir) == ['position-002.npy']
+        spilled = np.load(os.path.join(image_dir, 'position-002.npy'))
+        for position in [1, 2]:
+            np.testing.assert_array_equal(traces[position]['images'],
+                                          expected[position]['images'])
+        np.testing.assert_array_equal(spilled, [tube.sum(axis=0) + 4] * 3)
+        del traces, spilled
+    finally:
+        shutil.rmtree(image_dir)
+
+
+def test_traces_dict_projection_does_not_overflow():
+    tube = np.zeros((25, 64, 32), np.uint16)
+    tube[..., 12:20] = 60000
+    images = collections.OrderedDict()
+    images['Pre lesion 2x/Pos001_S001'] = tube
+    traces, _ = process.traces_dict(images, return_images=True)
+    projection = traces[1]['images']
+    assert projection.dtype == np.uint32
+    assert projection.max() == 25 * 60000
+
+
+def test_traces_dict_float32():
+    tube = np.zeros((4, 64, 32), np.uint8)
+    tube[..., 12:20] = 200
+    tube[:, 30:34] = 50
+    images = collections.OrderedDict()
+    images['1h to 2h pSCI/Pos001_S001'] = np.array([tube] * 3)
+    traces64, statistics64 = process.traces_dict(images)
+    traces32, statistics32 = process.traces_dict(images, dtype=np.float32)
+    assert all(tr.dtype == np.float32 for tr in traces32[1]['traces'])
+    for tr32, tr64 in zip(traces32[1]['traces'], traces64[1]['traces']):
+        np.testing.assert_allclose(tr32, tr64, rtol=1e-6)
+    np.testing.assert_allclose(statistics32.values, statistics64.values,
+                               rtol=1e-5)
+
+
+def test_traces_dict_downsample():
+    rows, cols = np.mgrid[:256, :128]
+    tube = (1000 * np.exp(-(cols - 40 - rows / 8.) ** 2 / 50.)).astype(
+                                                                np.uint16)
+    images = collections.OrderedDict()
+    images['1h to 2h pSCI/Pos001_S001'] = np.array([tube[np.newaxis]] * 3)
+    traces, statistics = process.traces_dict(images)
+    traces4, statistics4 = process.traces_dict(images, downsample=4)
+    for tr, tr4 in zip(traces[1]['traces'], traces4[1]['traces']):
+        np.testing.assert_allclose(tr4, tr, rtol=0.05, atol=5)
@@ -0,0 +1,89 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import collections as coll
+
+import numpy as np
+from numpy.testing import assert_equal, assert_raises
+from numpy.testing.decorators import skipif
+
+from lesion import readers
+
+try:
+    import tifffile
+    tifffile_unavailable = False
+except ImportError:
+    tifffile_unavailable = True
+
+
+def _series():
+    images = coll.OrderedDict()
+    images['Pre lesion 2x/Pos001_S001'] = np.ones((4, 6, 8), np.uint8)
+    images['1h to 2h pSCI/Pos001_S001'] = np.ones((3, 4, 6, 8), np.uint8)
+    return images
+
+
+def test_lazy_bioformats_import():
+    code = ("import sys, lesion.process; "
+            "sys.exit('javabridge' in sys.modules or "
+            "'bioformats' in sys.modules)")
+    assert subprocess.call([sys.executable, '-c', code]) == 0
+
+
+def test_get_reader_by_type():
+    assert isinstance(readers.get_reader(_series()), readers.NumpyReader)
+    assert isinstance(readers.get_reader('stack.tif'), readers.TiffReader)
+    assert isinstance(readers.get_reader('experiment.lif'),
+                      readers.BioformatsReader)
+    rdr = readers.get_reader(_series())
+    assert readers.get_reader(rdr) is rdr
+
+
+def test_get_reader_unknown_backend():
+    assert_raises(ValueError, readers.get_reader, _series(), 'nonexistent')
+
+
+def test_numpy_reader():
+    rdr = readers.get_reader(_series(), backend='numpy')
+    names, sizes, resolutions = rdr.metadata()
+    assert_equal(names, list(_series()))
+    assert_equal(sizes, [(1, 4, 6, 8, 1), (3, 4, 6, 8, 1)])
+    assert_equal(resolutions, [(1.0, 1.0, 1.0)] * 2)
+    images = list(rdr.series_iterator(desired_order='tzcyx', c=0))
+    assert_equal([im.shape for im in images],
+                 [(1, 4, 1, 6, 8), (3, 4, 1, 6, 8)])
+    assert_raises(ValueError, rdr.read_image_series, 2)
+
+
+@skipif(tifffile_unavailable)
+def test_tiff_reader():
+    path = tempfile.mkdtemp()
+    try:
+        for name, image in _series().items():
+            filename = os.path.join(path, *name.split('/')) + '.tif'
+            os.makedirs(os.path.dirname(filename))
+            tifffile.imwrite(filename, image)
+        rdr = readers.get_reader(path)
+        assert isinstance(rdr, readers.TiffReader)
+        names, sizes, resolutions = rdr.metadata()
+        assert_equal(sorted(names), sorted(_series()))
+        assert_equal(sorted(sizes), [(1, 4, 6, 8, 1), (3, 4, 6, 8, 1)])
+        image = rdr.read_image_series(names.index('1h to 2h pSCI/Pos001_S001'))
+        assert_equal(image.shape, (3, 4, 1, 6, 8))
+    finally:
+        shutil.rmtree(path)
+
+
+def test_get_reader_rejects_directory_without_images():
+    # for example, a store interrupted before its index was written
+    path = tempfile.mkdtemp()
+    try:
+        np.save(os.path.join(path, 'series-00000.npy'), np.ones((2, 2)))
+        assert not readers.TiffReader.accepts(path)
+        assert not readers.BioformatsReader.accepts(path)
+        assert_raises(ValueError, readers.get_reader, path)
+        assert_raises(ValueError, readers.get_reader, path, 'tiff')
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,76 @@
+import itertools as it
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose, assert_equal
+from scipy import optimize
+
+from lesion import stats
+
+
+def _recovery(t, plateau, amplitude, rate):
+    return plateau + amplitude * np.exp(-rate * t)
+
+
+def _table(seed=0):
+    random = np.random.RandomState(seed)
+    times = np.concatenate([[-2., -1.], np.arange(22.5, 72.5, 0.5)])
+    positions = range(1, 7)
+    names = ['min_max', 'slope', 'missing']
+    columns = pd.MultiIndex.from_tuples(list(it.product(positions, names)))
+    params = np.column_stack([random.uniform(0.5, 1, len(columns)),
+                              -random.uniform(0.2, 0.5, len(columns)),
+                              random.uniform(0.02, 0.5, len(columns))])
+    values = np.column_stack([_recovery(times - 22.5, *p) for p in params])
+    values += random.normal(scale=0.01, size=values.shape)
+    values[:2] = 100  # "Mark" and "Pre" timepoints aren't on the curve
+    values[random.uniform(size=values.shape) < 0.2] = np.nan
+    return pd.DataFrame(values, index=times, columns=columns)
+
+
+def test_fit_recovery_matches_curve_fit():
+    table = _table()
+    fits = stats.fit_recovery(table)
+    assert_equal(list(fits.index), list(table.columns))
+    for column in table.columns:
+        series = table[column]
+        series = series[(series.index >= 0) & series.notnull()]
+        t = series.index.values - series.index.values[0]
+        popt, _ = optimize.curve_fit(_recovery, t, series.values,
+                                     p0=(1, -0.5, 0.1))
+        rss = ((series.values - _recovery(t, *popt)) ** 2).sum()
+        fit = fits.loc[column]
+        assert fit['npoints'] == len(series)
+        assert_allclose(fit['rate'], popt[2], rtol=1e-3)
+        assert_allclose(fit['half_time'], np.log(2) / popt[2], rtol=1e-3)
+        assert_allclose(fit['plateau'], popt[0], rtol=1e-3, atol=1e-4)
+        assert_allclose(fit['amplitude'], popt[1], rtol=1e-3, atol=1e-4)
+        assert fit['start_time'] == series.index[0]
+        assert_allclose(fit['rss'], rss, rtol=1e-3)
+
+
+def test_fit_recovery_too_few_points():
+    table = _table()
+    table.iloc[2:4, 0] = 0.5
+    table.iloc[4:, 0] = np.nan
+    table.iloc[:, 1] = np.nan
+    fits = stats.fit_recovery(table)
+    assert_equal(fits['npoints'].values[:2], [2, 0])
+    assert np.all(np.isnan(fits['half_time'].values[:2]))
+    assert np.all(np.isfinite(fits['half_time'].values[2:]))
+
+
+def test_fit_recovery_late_start():
+    # a late first timepoint mustn't be extrapolated back to t = 0, and
+    # large, flat signals mustn't lose the residual to cancellation
+    t = np.arange(600., 660., 0.5)
+    table = pd.DataFrame({'a': 5e4 + 2e4 * np.exp(-0.3 * (t - 600))},
+                         index=t)
+    fit = stats.fit_recovery(table).loc['a']
+    assert_equal(fit['start_time'], 600.)
+    assert_allclose([fit['plateau'], fit['amplitude'], fit['rate']],
+                    [5e4, 2e4, 0.3], rtol=1e-4)
+    model = _recovery(t - fit['start_time'], fit['plateau'],
+                      fit['amplitude'], fit['rate'])
+    assert_allclose(fit['rss'], ((table['a'] - model) ** 2).sum(), rtol=1e-3)
+    assert fit['rss'] < 1e-2
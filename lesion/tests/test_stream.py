@@ -0,0 +1,165 @@
+import os
+import asyncio
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import numpy as np
+from numpy.testing import assert_allclose
+
+from lesion import lifio, process, readers, stream
+
+
+test_lif = os.path.join(os.path.dirname(__file__), 'mouse-kidney.lif')
+try:
+    import javabridge, bioformats
+    bioformats_unavailable = False
+except ImportError:
+    bioformats_unavailable = True
+
+
+def _images(npositions=3):
+    tube = np.zeros((4, 64, 32), np.uint16)
+    tube[..., 12:20] = 200
+    tube[:, 30:36] //= 2
+    images = collections.OrderedDict()
+    for position in range(1, npositions + 1):
+        images['Pre lesion 2x/Pos%03i_S001' % position] = tube
+        images['1h to 2h pSCI/Pos%03i_S001' % position] = np.array([tube] * 3)
+    return images
+
+
+class CountingReader(readers.NumpyReader):
+    """Record reads, optionally blocking until released."""
+    def __init__(self, source):
+        readers.NumpyReader.__init__(self, source)
+        self.reads = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def read_image_series(self, series_id=0, *args, **kwargs):
+        self.release.wait()
+        self.reads.append(series_id)
+        return readers.NumpyReader.read_image_series(self, series_id,
+                                                     *args, **kwargs)
+
+
+async def _collect(fin, **kwargs):
+    return [item async for item in stream.aprocess(fin, **kwargs)]
+
+
+def test_aprocess_matches_traces_dict():
+    images = _images()
+    results = asyncio.run(_collect(images))
+    traces, statistics = process.traces_dict(images)
+    assert len(results) == sum(len(t['times']) for t in traces.values())
+    seen = collections.defaultdict(int)
+    for position, time, tr, stats in results:
+        k = seen[position]
+        seen[position] += 1
+        assert traces[position]['times'][k] == time
+        assert_allclose(tr, traces[position]['traces'][k])
+        for name, value in stats.items():
+            assert_allclose(value, statistics.loc[time, (position, name)],
+                            rtol=1e-6)
+
+
+def test_aprocess_downsample():
+    images = _images()
+    results = asyncio.run(_collect(images, downsample=4))
+    traces, statistics = process.traces_dict(images, downsample=4)
+    seen = collections.defaultdict(int)
+    for position, time, tr, stats in results:
+        assert_allclose(tr, traces[position]['traces'][seen[position]])
+        seen[position] += 1
+
+
+def test_aprocess_backpressure():
+    rdr = CountingReader(_images(npositions=4))
+
+    async def first_then_stop():
+        agen = stream.aprocess(rdr, max_pending=2)
+        first = await agen.__anext__()
+        await asyncio.sleep(0.1)
+        reads = list(rdr.reads)
+        await agen.aclose()
+        return first, reads
+
+    first, reads = asyncio.run(first_then_stop())
+    assert first[:2] == (1, -1.)
+    # the consumed series, plus at most `max_pending` read ahead
+    assert len(reads) <= 3
+
+
+def test_aprocess_cancellation():
+    rdr = CountingReader(_images())
+    rdr.release.clear()
+
+    async def cancel_while_blocked():
+        task = asyncio.ensure_future(_collect(rdr, max_pending=1))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return True
+        return False
+
+    try:
+        assert asyncio.run(cancel_while_blocked())
+    finally:
+        rdr.release.set()
+    assert len(rdr.reads) <= 1
+
+
+class JVMReader(readers.BioformatsReader):
+    """Serve in-memory images, recording JVM attachment during reads."""
+    def __init__(self, source):
+        readers.BioformatsReader.__init__(self, source)
+        self.images = readers.NumpyReader(source)
+        self.attached = collections.defaultdict(int)
+        self.unattached_reads = 0
+
+    def series_count(self):
+        return self.images.series_count()
+
+    def metadata(self, *args):
+        return self.images.metadata(*args)
+
+    def read_image_series(self, *args):
+        if self.attached[threading.get_ident()] != 1:
+            self.unattached_reads += 1
+        return self.images.read_image_series(*args)
+
+
+def test_aprocess_detaches_from_jvm():
+    rdr = JVMReader(_images())
+
+    def attach_thread():
+        rdr.attached[threading.get_ident()] += 1
+
+    def detach_thread():
+        rdr.attached[threading.get_ident()] -= 1
+
+    attach, detach = lifio.attach_thread, lifio.detach_thread
+    lifio.attach_thread, lifio.detach_thread = attach_thread, detach_thread
+    try:
+        results = asyncio.run(_collect(rdr))
+    finally:
+        lifio.attach_thread, lifio.detach_thread = attach, detach
+    assert len(results) == 12
+    assert rdr.unattached_reads == 0
+    assert set(rdr.attached.values()) == {0}
+
+
+@pytest.mark.skipif(bioformats_unavailable or not os.path.isfile(test_lif),
+                    reason="requires bioformats and the test LIF file")
+def test_bioformats_read_in_worker_thread():
+    rdr = readers.BioformatsReader(test_lif)
+    assert rdr.series_count() == 2  # starts the JVM in this thread
+    with ThreadPoolExecutor(1) as executor:
+        image = executor.submit(stream._locked, threading.Lock(), rdr,
+                                rdr.read_image_series, 0, None, None, 0,
+                                'tzcyx').result()
+    assert image.shape == (1, 25, 1, 512, 512)
@@ -0,0 +1,52 @@
+import numpy as np
+from lesion import trace
+
+from numpy.testing import assert_allclose
+
+
+def _tilted_tube(shape=(512, 512), top=200, bottom=300, sigma=12.,
+                 seed=0):
+    rows, cols = np.mgrid[:shape[0], :shape[1]].astype(float)
+    centers = top + (bottom - top) * rows / (shape[0] - 1)
+    image = 1000 * np.exp(-(cols - centers) ** 2 / (2 * sigma ** 2))
+    image[shape[0] // 3:shape[0] // 2] *= 0.2  # the lesion
+    image += np.random.RandomState(seed).poisson(20, size=shape)
+    return image.astype(np.uint16)
+
+
+def test_multiresolution_matches_full_resolution():
+    image = _tilted_tube()
+    full = trace.trace_profile(image)
+    for factor in [2, 4, 8]:
+        coarse = trace.trace_profile(image, downsample=factor)
+        assert coarse.shape == full.shape
+        assert_allclose(coarse, full, rtol=0.05, atol=5)
+
+
+def test_multiresolution_odd_shape():
+    image = _tilted_tube(shape=(301, 517))
+    full = trace.trace_profile(image)
+    coarse = trace.trace_profile(image, downsample=4)
+    assert_allclose(coarse, full, rtol=0.05, atol=5)
+
+
+class RowRecorder(object):
+    """Wrap an image, recording which of its rows are read."""
+    def __init__(self, image):
+        self.image = image
+        self.shape = image.shape
+        self.rows = set()
+
+    def __getitem__(self, index):
+        rows = np.arange(self.shape[0])[index]
+        self.rows.update(np.atleast_1d(rows).tolist())
+        return self.image[index]
+
+
+def test_multiresolution_reads_only_edge_rows():
+    image = _tilted_tube(shape=(2048, 2048), top=800, bottom=1200, sigma=48)
+    recorder = RowRecorder(image)
+    ends = trace._coarse_to_fine_ends(recorder, 5., 4)
+    assert ends == trace._coarse_to_fine_ends(image, 5., 4)
+    # the endpoint search must not touch the interior of the image
+    assert recorder.rows == set([0, 1, 2, 3, 2044, 2045, 2046, 2047])
@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import collections as coll
 from lesion import lifio
 
@@ -49,6 +51,23 @@ def test_read_one_channel():
     assert_equal(np.squeeze(im0).shape, (512, 512))
 
 
+@skipif(test_lif_unavailable)
+def test_read_selection():
+    full = lifio.read_image_series(test_lif, desired_order='tzcyx')
+    part = lifio.read_image_series(test_lif, z=[3, 1], c=2,
+                                   desired_order='tzcyx')
+    assert_equal(part, full[:, [3, 1]][:, :, 2:3])
+
+
+def test_sanitize_czt():
+    shape = [512, 256, 4, 25, 3]
+    czt_list, shape = lifio._sanitize_czt(0, None, [1, 2], shape, 'XYCZT')
+    assert_equal(shape, [512, 256, 1, 25, 2])
+    assert_equal(len(czt_list), 50)
+    assert_equal(czt_list[:3], [(0, 0, 1), (0, 0, 2), (0, 1, 1)])
+    assert_equal(czt_list[-1], (0, 24, 2))
+
+
 @skipif(test_lif_unavailable)
 def test_series_iterator():
     series_iter = lifio.series_iterator(test_lif)
@@ -72,6 +91,20 @@ def test_invalid_series_id():
     assert_raises(ValueError, lifio.read_image_series, test_lif, series_id=5)
 
 
+@skipif(test_lif_unavailable)
+def test_transcode():
+    path = tempfile.mkdtemp()
+    try:
+        store = lifio.transcode(test_lif, path)
+        assert lifio.is_store(path)
+        assert_equal(lifio.metadata(path), lifio.metadata(test_lif))
+        im0 = lifio.read_image_series(test_lif, 1, desired_order='tzcyx')
+        im1 = lifio.read_image_series(store, 1, desired_order='tzcyx')
+        assert_equal(im0, im1)
+    finally:
+        shutil.rmtree(path)
+
+
 def test_done():
     lifio.done()
     assert lifio.VM_KILLED
@@ -85,6 +118,70 @@ def test_image_reader_killed_error():
     assert_raises(RuntimeError, lifio.image_reader, test_lif)
 
 
+def test_attach_thread_killed_error():
+    assert_raises(RuntimeError, lifio.attach_thread)
+
+
 def test_bad_series_name():
     sname = 'Totally wrong string'
     assert_raises(ValueError, lifio.parse_series_name, sname)
+
+
+def _toy_store(path):
+    names = ['Pre lesion 2x/Pos008_S001', '22.5h to 23.5h pSCI/Pos008_S001']
+    sizes = [(1, 2, 4, 5, 3), (3, 2, 4, 5, 3)]
+    resolutions = [(2.0, 0.5, 0.25)] * 2
+    images = [np.arange(np.prod(s)).reshape((s[0], s[1], s[4], s[2], s[3]))
+              for s in sizes]
+    return lifio.write_store(path, names, sizes, resolutions, iter(images))
+
+
+def test_store_metadata():
+    path = tempfile.mkdtemp()
+    try:
+        store = _toy_store(path)
+        assert_equal(store.index['positions'], [8, 8])
+        assert_equal(store.index['times'], [[-1.], [22.5, 23., 23.5]])
+        names, sizes, reso = lifio.metadata(path, array_order='zcyxt')
+        assert_equal(sizes, [(2, 3, 4, 5, 1), (2, 3, 4, 5, 3)])
+        assert_equal(reso, [(2.0, 0.5, 0.25)] * 2)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_store_read_is_memory_mapped():
+    path = tempfile.mkdtemp()
+    try:
+        _toy_store(path)
+        im = lifio.read_image_series(path, 1, c=0, desired_order='ctzyx')
+        assert_equal(im.shape, (1, 3, 2, 4, 5))
+        assert isinstance(im.base, np.memmap) or isinstance(im, np.memmap)
+        full = lifio.read_image_series(path, 1)
+        assert_equal(im[0], full[:, :, 0])
+        series = list(lifio.series_iterator(path, z=[1]))
+        assert_equal([s.shape for s in series],
+                     [(1, 1, 3, 4, 5), (3, 1, 3, 4, 5)])
+        assert_raises(ValueError, lifio.read_image_series, path, 2)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_series_index():
+    names = ['Pre lesion 2x/Pos002_S001', 'Mark_and_Find_001/Pos001_S001',
+             '22.5h to 24h pSCI/Pos001_S001', '24.5h to 26h pSCI/Pos001_S001']
+    sizes = [(1, 25, 512, 512, 1), (1, 25, 512, 512, 1),
+             (4, 25, 512, 512, 1), (4, 25, 512, 512, 1)]
+    resolutions = [(1., 0.5, 0.5)] * 4
+    index = lifio.SeriesIndex.from_metadata(names, sizes, resolutions)
+    assert_equal(index.positions(), [1, 2])
+    assert_equal(index.for_position(1), [1, 2, 3])
+    assert_equal(index.covering(23, 24.5), [2, 3])
+    assert_equal(index.covering(-2, -2), [1])
+    assert_equal(index.times(3), [24.5, 25., 25.5, 26.])
+    assert_equal(index.series['size'][index.for_position(1), 0], [1, 4, 4])
+    for i, name in enumerate(names):
+        position, times = lifio.parse_series_name(name)
+        assert_equal(index.series['position'][i], position)
+        assert_equal(index.times(i), times)
+    assert_raises(ValueError, lifio.SeriesIndex.from_metadata,
+                  ['Totally wrong string'])
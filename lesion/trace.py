@@ -1,7 +1,9 @@
 import sys
 import numpy as np
 from scipy import ndimage as nd
-from skimage.measure import profile_line
+
+from . import dtypes
+from . import kernels
 
 
 def estimate_mode_width(distribution):
@@ -37,14 +39,103 @@ def estimate_mode_width(distribution):
     return mode, whm
 
 
-def trace_profile(image, sigma=5., width_factor=1., check_vertical=False):
+def _downsample_rows(rows, factor):
+    """Average a band of rows, then average blocks of columns.
+
+    Parameters
+    ----------
+    rows : array, shape (K, N)
+        The band of rows, such as the first or last `factor` rows of an
+        image.
+    factor : int
+        The number of columns averaged into each output value. Columns
+        that don't fill a complete block are discarded.
+
+    Returns
+    -------
+    small : 1D array of float, shape (N // factor,)
+        The downsampled row.
+
+    Examples
+    --------
+    >>> rows = np.arange(16).reshape((2, 8))
+    >>> _downsample_rows(rows, 2)
+    array([  4.5,   6.5,   8.5,  10.5])
+    """
+    ncols = rows.shape[1] // factor
+    blocks = rows[:, :ncols * factor].reshape((rows.shape[0], ncols, factor))
+    return blocks.mean(axis=2, dtype=float).mean(axis=0)
+
+
+def _refine_mode(row, coarse_loc, factor, sigma):
+    """Find the full-resolution mode of `row` near a coarse estimate.
+
+    Parameters
+    ----------
+    row : 1D array of int or float
+        The full-resolution intensity distribution.
+    coarse_loc : int
+        The location of the mode in a version of `row` downsampled by
+        `factor`.
+    factor : int
+        The downsampling factor used to find `coarse_loc`.
+    sigma : float
+        Smooth the searched part of `row` by a Gaussian of this sigma.
+
+    Returns
+    -------
+    loc : int
+        The location of the mode in `row`, within one coarse pixel of
+        the coarse estimate.
+    """
+    start = max(coarse_loc * factor - factor, 0)
+    stop = min(coarse_loc * factor + 2 * factor, row.size)
+    pad = int(np.ceil(4 * sigma))
+    pstart, pstop = max(start - pad, 0), min(stop + pad, row.size)
+    smoothed = nd.gaussian_filter1d(row[pstart:pstop].astype(float), sigma)
+    window = smoothed[start - pstart:stop - pstart]
+    return start + window.argmax()
+
+
+def _coarse_to_fine_ends(image, sigma, factor):
+    """Estimate the tube endpoints and width from downsampled edge rows.
+
+    Parameters
+    ----------
+    image : array, shape (M, N)
+        The input image.
+    sigma : float
+        The smoothing sigma, in full-resolution pixels.
+    factor : int
+        The downsampling factor.
+
+    Returns
+    -------
+    top_loc, bottom_loc : int
+        The location of the tube in the first and last rows of `image`.
+    whm : int
+        The width of the tube at half-maximum, in full-resolution
+        pixels.
+    """
+    # only the bands of rows at each end are read, never the whole image
+    small = np.array([_downsample_rows(image[:factor], factor),
+                      _downsample_rows(image[-factor:], factor)])
+    small = nd.gaussian_filter1d(small, float(sigma) / factor, axis=1)
+    modes, whms = kernels.mode_width(small)
+    top_loc = _refine_mode(image[0], modes[0], factor, sigma)
+    bottom_loc = _refine_mode(image[-1], modes[1], factor, sigma)
+    return top_loc, bottom_loc, max(whms) * factor
+
+
+def trace_profile(image, sigma=5., width_factor=1., check_vertical=False,
+                  downsample=1, dtype=np.float64):
     """Trace the intensity profile of a tubular structure in an image.
 
     Parameters
     ----------
     image : array of int or float, shape (M, N[, P])
         The input image. If 3D, the first dimension is flattened by
-        summing along that axis.
+        summing along that axis, in a type wide enough not to overflow.
     sigma : float, optional
         Convolve the intensity with this sigma to estimate the start
         and end of the scan lines.
@@ -55,6 +146,15 @@ def trace_profile(image, sigma=5., width_factor=1., check_vertical=False):
         Check whether the tube is arranged top-to-bottom in the image.
         If `False`, it is assumed to be vertical, otherwise, the
         orientation is automatically determined from the image.
+    downsample : int, optional
+        If greater than 1, find the tube's endpoints and width on the
+        first and last `downsample` rows of the image, downsampled by
+        this factor, then refine the endpoints locally at full
+        resolution. Only the final profile is sampled from the
+        full-resolution image. The width estimate has an error of up
+        to `downsample` pixels.
+    dtype : numpy dtype, optional
+        The floating point type of the profile.
 
     Returns
     -------
@@ -75,21 +175,26 @@ def trace_profile(image, sigma=5., width_factor=1., check_vertical=False):
     array([ 18.,   0.,  18.])
     """
     if image.ndim > 2:
-        image = image.sum(axis=0)
+        image = image.sum(axis=0, dtype=dtypes.projection_dtype(
+                                                image.dtype, image.shape[0]))
     if check_vertical:
         top_bottom_mean = np.mean(image[[0, image.shape[0] - 1], :])
         left_right_mean = np.mean(image[:, [0, image.shape[1] - 1]])
         if top_bottom_mean < left_right_mean:
             image = image.T
-    top_distribution = nd.gaussian_filter1d(image[0], sigma)
-    bottom_distribution = nd.gaussian_filter1d(image[-1], sigma)
-    top_loc, top_whm = estimate_mode_width(top_distribution)
-    bottom_loc, bottom_whm = estimate_mode_width(bottom_distribution)
+    if downsample > 1:
+        top_loc, bottom_loc, whm = _coarse_to_fine_ends(image, sigma,
+                                                        downsample)
+    else:
+        distributions = nd.gaussian_filter1d(image[[0, -1]], sigma, axis=1)
+        (top_loc, bottom_loc), whms = kernels.mode_width(distributions)
+        whm = max(whms)
     angle = np.arctan(np.abs(float(bottom_loc - top_loc)) / image.shape[0])
-    width = np.int(np.ceil(max(top_whm, bottom_whm) * np.cos(angle)))
-    profile = profile_line(image,
-                           (0, top_loc), (image.shape[0] - 1, bottom_loc),
-                           linewidth=width, mode='nearest')
+    width = np.int(np.ceil(whm * np.cos(angle)))
+    profile = kernels.profile_line(image,
+                                   (0, top_loc),
+                                   (image.shape[0] - 1, bottom_loc),
+                                   linewidth=width, dtype=dtype)
     return profile
 
 